@@ -0,0 +1,265 @@
+#!/usr/bin/python
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import ipc_bridge
+import sphero_sim
+from command_reader import CommandFileReader
+from control_events import ControlEvents
+from coordinate_transform import CoordinateTransform
+from feedback_writer import FeedbackWriter
+from netlogo_parser import NetLogoParser
+from roll_dispatcher import RollDispatcher, roll_arguments
+from sensor_filter import ConstantVelocityFilter
+from sensor_store import SensorStore
+from sensor_stream import SensorDataStream
+from tick_profiler import TickProfiler
+
+FORMAT_VERSION = 1
+STAGES = ["ingest", "dispatch", "sensor", "snapshot", "transform", "proceed"]
+COMPARED_LATENCIES = ["p50_ms", "p90_ms"]
+
+
+# runs the hot paths of the control loop in bidirectional.py for one fleet size, tick by tick:
+# ingest     read the new lines of commandsToRobots.txt and parse them
+# dispatch   turn the targets into roll commands and wait until the roll workers sent them
+# sensor     data stream callbacks of every Sphero, samples_per_tick samples each
+# snapshot   fleet-wide view of the sensor data, filtered
+# transform  odometry and headings to NetLogo coordinates
+# proceed    format the feedback and publish proceed.txt
+# simulated Spheros without link latency stand in for the robots, a stand-in NetLogo appends the command lines
+# and deletes proceed.txt between the ticks, both in a temporary directory (in memory where /dev/shm exists)
+class FleetBenchmark(object):
+    def __init__(self, number_of_spheros, samples_per_tick=2, scale=2.5, seed=1):
+        self.number_of_spheros = number_of_spheros
+        self.samples_per_tick = samples_per_tick
+        self.random = np.random.RandomState(seed)
+
+        self.directory = tempfile.mkdtemp(prefix="sphero-benchmark-",
+                                          dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+        self.command_path = os.path.join(self.directory, "commandsToRobots.txt")
+        self.proceed_path = os.path.join(self.directory, "proceed.txt")
+
+        world = sphero_sim.SimulatedWorld(link_latency=0.0, link_jitter=0.0, connect_time=0.0, seed=seed)
+        self.spheros = [sphero_sim.Sphero("Sphero", address, world)
+                        for address in sphero_sim.simulated_addresses(number_of_spheros)]
+        for sphero in self.spheros:
+            sphero.connect()  # the world is never started, nothing moves unless the benchmark feeds samples
+        self.roll_dispatcher = RollDispatcher(self.spheros)
+
+        self.command_reader = CommandFileReader(self.command_path)
+        self.netlogo_parser = NetLogoParser(number_of_spheros)
+        self.netlogo_parser.parse_lines(ipc_bridge.stand_in_config_lines(number_of_spheros, scale))
+
+        self.internal_headings = self.random.uniform(0, 360, number_of_spheros)
+        self.coordinate_transform = CoordinateTransform(self.internal_headings, self.netlogo_parser.scale)
+        self.coordinate_transform.set_origin(self.netlogo_parser.first_netlogo_pos, np.zeros((number_of_spheros, 2)))
+
+        sample_period = 0.1 / samples_per_tick
+        self.sensor_store = SensorStore(number_of_spheros, sample_period=sample_period)
+        self.sensor_filter = ConstantVelocityFilter(number_of_spheros)
+        self.control_events = ControlEvents(number_of_spheros, [])
+        self.sensor_data_stream = SensorDataStream(self.sensor_store, self.control_events)  # without recording
+        self.feedback_writer = FeedbackWriter(number_of_spheros)
+
+        # the robots drive in straight lines at random headings, odometry in cm, velocities in mm/s
+        self.positions = np.zeros((number_of_spheros, 2))
+        self.velocities = self.random.uniform(-300, 300, (number_of_spheros, 2))
+        self.sample_period = sample_period
+        self.samples = 0
+
+    # the data stream packets of the next tick, built before the tick so only the callbacks are timed
+    def _next_packets(self):
+        packets = []
+        for _ in range(self.samples_per_tick):
+            self.positions += self.velocities / 10 * self.sample_period
+            packets.extend({'ODOM_X': int(x), 'ODOM_Y': int(y), 'VELOCITY_X': int(vx), 'VELOCITY_Y': int(vy)}
+                           for x, y, vx, vy in np.hstack([self.positions, self.velocities]).tolist())
+        return packets
+
+    def _write_commands(self):
+        headings = self.random.uniform(0, 360, self.number_of_spheros)
+        speeds = self.random.randint(0, 40, self.number_of_spheros).tolist()
+        with open(self.command_path, "a") as txt_file:
+            txt_file.write("\n".join(ipc_bridge.stand_in_command_lines(headings, speeds)) + "\n")
+
+    def tick(self, tick_profiler):
+        self._write_commands()
+        packets = self._next_packets()
+        self.control_events.reset_samples()
+        parser = self.netlogo_parser
+
+        tick_profiler.start_tick()
+        parser.parse_lines(self.command_reader.read_new_lines())
+        tick_profiler.lap("ingest")
+
+        speed_ints, heading_ints = roll_arguments(self.internal_headings, parser.target_headings,
+                                                  parser.target_speeds)
+        self.roll_dispatcher.submit_all(speed_ints.tolist(), heading_ints.tolist())
+        self.roll_dispatcher.wait()
+        tick_profiler.lap("dispatch")
+
+        callback = self.sensor_data_stream.callback
+        for index, packet in enumerate(packets):
+            callback(packet, index % self.number_of_spheros)
+        tick_profiler.lap("sensor")
+
+        sensor_snapshot = self.sensor_store.snapshot(sensor_filter=self.sensor_filter)
+        tick_profiler.lap("snapshot")
+
+        netlogo_pos = self.coordinate_transform.to_netlogo(sensor_snapshot.positions)
+        measured_headings = self.coordinate_transform.to_netlogo_headings(sensor_snapshot.headings)
+        tick_profiler.lap("transform")
+
+        self.feedback_writer.write(self.feedback_writer.lines(netlogo_pos, measured_headings, sensor_snapshot.speeds),
+                                   self.proceed_path)
+        tick_profiler.lap("proceed")
+        tick_profiler.end_tick()
+
+        self.samples += len(packets)
+        os.remove(self.proceed_path)  # read by NetLogo
+
+    # returns the results of the measured ticks as a dictionary, after warm-up ticks that are not measured
+    def run(self, ticks, warmup_ticks=10):
+        self.roll_dispatcher.start()
+        try:
+            for _ in range(warmup_ticks):
+                self.tick(TickProfiler(STAGES))
+            self.samples = 0
+            tick_profiler = TickProfiler(STAGES)
+            for _ in range(ticks):
+                self.tick(tick_profiler)
+        finally:
+            self.close()
+
+        stages = {}
+        for stage in STAGES:
+            stages[stage] = latency_summary(tick_profiler.histograms[stage])
+        sensor_time = tick_profiler.histograms["sensor"].total
+        return {"spheros": self.number_of_spheros,
+                "ticks": ticks,
+                "stages": stages,
+                "tick": latency_summary(tick_profiler.tick_histogram),
+                "sensor_samples_per_s": self.samples / sensor_time if sensor_time else 0.0,
+                "deadline_misses": self.roll_dispatcher.deadline_misses,
+                "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+    def close(self):
+        self.roll_dispatcher.stop()
+        self.control_events.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def latency_summary(histogram):
+    count = max(histogram.count, 1)
+    return {"mean_ms": 1000 * histogram.total / count,
+            "p50_ms": 1000 * histogram.percentile(50),
+            "p90_ms": 1000 * histogram.percentile(90),
+            "p99_ms": 1000 * histogram.percentile(99),
+            "max_ms": 1000 * histogram.maximum}
+
+
+# every fleet size runs in a fresh process, so its peak memory and threads do not carry over to the next one
+def run_fleet_benchmark(arguments):
+    number_of_spheros, ticks = arguments
+    return FleetBenchmark(number_of_spheros).run(ticks)
+
+
+def run_benchmarks(fleet_sizes, ticks):
+    pool = multiprocessing.Pool(processes=1, maxtasksperchild=1)
+    try:
+        fleets = pool.map(run_fleet_benchmark, [(number_of_spheros, ticks) for number_of_spheros in fleet_sizes])
+    finally:
+        pool.close()
+        pool.join()
+    return {"format": FORMAT_VERSION,
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "machine": platform.node(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "fleets": dict((str(fleet["spheros"]), fleet) for fleet in fleets)}
+
+
+# returns a description of every latency and memory value that got worse than the baseline allows
+# latencies may grow by the relative tolerance plus min_slack_ms, so stages of a few microseconds do not flap
+def compare_to_baseline(results, baseline, tolerance=0.3, memory_tolerance=0.1, min_slack_ms=0.02):
+    if baseline.get("format") != FORMAT_VERSION:
+        raise ValueError("the baseline was written by a different version of benchmark.py")
+    regressions = []
+    for fleet_size in sorted(results["fleets"], key=int):
+        fleet = results["fleets"][fleet_size]
+        baseline_fleet = baseline["fleets"].get(fleet_size)
+        if baseline_fleet is None:
+            continue
+        stages = [(stage, fleet["stages"][stage], baseline_fleet["stages"].get(stage)) for stage in STAGES] + \
+            [("tick", fleet["tick"], baseline_fleet["tick"])]
+        for stage, latencies, baseline_latencies in stages:
+            if baseline_latencies is None:
+                continue
+            for key in COMPARED_LATENCIES:
+                if latencies[key] > baseline_latencies[key] * (1 + tolerance) + min_slack_ms:
+                    regressions.append("{0} Spheros, {1} {2}: {3:.3f} ms, baseline {4:.3f} ms".format(
+                        fleet_size, stage, key[:-3], latencies[key], baseline_latencies[key]))
+        if fleet["peak_rss_kb"] > baseline_fleet["peak_rss_kb"] * (1 + memory_tolerance):
+            regressions.append("{0} Spheros, peak memory: {1} kB, baseline {2} kB".format(
+                fleet_size, fleet["peak_rss_kb"], baseline_fleet["peak_rss_kb"]))
+    return regressions
+
+
+def summary(results):
+    lines = ["{0:>7} {1:>9} {2}   {3:>9}   {4:>9}".format(
+        "Spheros", "tick p50", " ".join("{0:>9}".format(stage) for stage in STAGES), "samples/s", "peak kB")]
+    for fleet_size in sorted(results["fleets"], key=int):
+        fleet = results["fleets"][fleet_size]
+        lines.append("{0:>7} {1:9.3f} {2}   {3:9.0f}   {4:9d}".format(
+            fleet_size, fleet["tick"]["p50_ms"],
+            " ".join("{0:9.3f}".format(fleet["stages"][stage]["p50_ms"]) for stage in STAGES),
+            fleet["sensor_samples_per_s"], fleet["peak_rss_kb"]))
+    return "p50 latencies in ms\n" + "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks the control loop hot paths of bidirectional.py "
+                                                 "with simulated fleets and compares them to a baseline.")
+    parser.add_argument("--fleets", type=int, nargs="+", default=[4, 32, 256, 1024], help="fleet sizes")
+    parser.add_argument("--ticks", type=int, default=200, help="measured ticks per fleet size")
+    parser.add_argument("--output", default="benchmark_results.json", help="results of this run (JSON)")
+    parser.add_argument("--baseline", default="benchmark_baseline.json", help="stored results to compare to")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.3,
+                        help="relative latency increase that still passes the check")
+    parser.add_argument("--memory-tolerance", type=float, default=0.1,
+                        help="relative peak memory increase that still passes the check")
+    arguments = parser.parse_args()
+
+    benchmark_results = run_benchmarks(arguments.fleets, arguments.ticks)
+    print summary(benchmark_results)
+    with open(arguments.output, "w") as json_file:
+        json.dump(benchmark_results, json_file, indent=2, sort_keys=True)
+
+    if arguments.save_baseline:
+        shutil.copyfile(arguments.output, arguments.baseline)
+        print "Saved the results as baseline to " + arguments.baseline + "."
+    elif os.path.exists(arguments.baseline):
+        with open(arguments.baseline) as json_file:
+            baseline_results = json.load(json_file)
+        found_regressions = compare_to_baseline(benchmark_results, baseline_results, arguments.tolerance,
+                                                arguments.memory_tolerance)
+        print "Compared to the baseline of {0} on {1}:".format(baseline_results["time"], baseline_results["machine"])
+        if found_regressions:
+            print "\n".join(found_regressions)
+            sys.exit(1)
+        print "no regressions."
+    else:
+        print "No baseline at " + arguments.baseline + ", store one with --save-baseline."
@@ -6,17 +6,35 @@
 ########################################################################################################################
 ########################################################################################################################
 
-import math
 import numpy as np
 import os
 import sys
 import time
 import traceback
 from functools import partial
-from sphero_driver import sphero_driver
-from threading import Thread
 
+import ipc_bridge
 import sphero_helper
+import sphero_sim
+from command_reader import CommandFileReader
+from connection_manager import ConnectionManager
+from control_events import ControlEvents
+from coordinate_transform import CoordinateTransform
+from feedback_writer import FeedbackWriter
+from fleet_shards import ShardedFleet
+from netlogo_parser import NetLogoParser
+from roll_dispatcher import RollDispatcher, roll_arguments
+from run_recorder import RunRecorder
+from sensor_filter import ConstantVelocityFilter
+from sensor_store import SensorStore
+from sensor_stream import SensorDataStream
+from stream_rate import StreamRateController
+from tick_profiler import TickProfiler
+
+try:
+    from sphero_driver import sphero_driver
+except ImportError:  # only headless runs with simulated Spheros work without the driver
+    sphero_driver = sphero_sim
 
 ########################################################################################################################
 ########################################################################################################################
@@ -38,6 +56,14 @@ s8 = "68:86:E7:09:F3:14"  # RBR Veronika
 ########################################################################################################################
 # TODO BEFORE SCRIPT START always change to the Spheros you want to use
 sphero_addresses = [s5, s6, s7, s8]
+
+# headless runs without Bluetooth: simulated Spheros replace the addresses above and all console questions
+use_simulated_spheros = False
+number_of_simulated_spheros = 500
+
+# sharded mode: worker processes that each connect and drive a part of the fleet, 0 = all Spheros in this process
+number_of_shards = 0
+shard_adapters = []  # local Bluetooth adapter address per shard (see hciconfig), missing or None = default adapter
 ########################################################################################################################
 ########################################################################################################################
 # Global variables
@@ -52,6 +78,36 @@ config_file_processed = False
 sphero_init_direction_roll_speed = 20  # percentage of max speed
 sphero_init_direction_roll_threshold = 1  # degrees
 
+# "file": config.txt, commandsToRobots.txt and proceed.txt, works with the unmodified NetLogo model
+# "socket": framed request/response messages on netlogo_socket_address ("host:port" or a Unix socket path)
+netlogo_transport = "file"
+netlogo_socket_address = "127.0.0.1:50007"
+
+proceed_refresh_interval = 0.02  # s, how long to wait for new commands before rewriting proceed.txt
+roll_dispatch_deadline = 0.1  # s, how long a tick waits for the roll commands to be sent
+# one list per tick instead of three foreach commands, needs the apply-feedback procedure of bidirectional.nlogo
+compact_feedback = False
+
+# sample_div=40: divisor of the maximum sensor sampling rate (400 Hz), 20<x<50 recommended
+sensor_sample_divisor = 40
+sensor_frames_per_packet = 1  # sphero_driver only parses one frame per DATA_STRM packet
+# move the last positions along their velocities to the time proceed.txt is written, instead of sending them as they are
+extrapolate_sensor_data = False
+filter_sensor_data = False  # constant-velocity Kalman filter over all samples, replaces the extrapolation
+
+# True: choose the divisor from the fleet size and the NetLogo tick period and adjust it during the run,
+# sensor_sample_divisor is then ignored
+adapt_stream_rate = False
+stream_link_budget = 4000.0  # bytes/s for all data streams, about what 6 Spheros need at divisor 40
+expected_tick_period = 0.1  # s between NetLogo ticks until the real tick period was measured
+
+tick_profile_export = None  # e.g. "tick_profile.csv" or "tick_profile.jsonl" to keep one record per tick
+run_record_path = None  # e.g. "run.rec" to record sensor data, rolls and feedback for run_replay.py
+
+connection_timeout = 20.0  # s every Sphero gets to connect and, later, to set up its streams
+connection_retries = 3  # rounds before the user is asked whether to retry, drop or stop for Spheros that keep failing
+stream_health_timeout = 2.0  # s until a Sphero's first data stream packet has to arrive
+
 ########################################################################################################################
 ########################################################################################################################
 # Global helper variables
@@ -60,29 +116,84 @@ sphero_init_direction_roll_threshold = 1  # degrees
 # the variables control what happens after a model run
 restart = True
 bt_error_restart = False
+connect_rounds = 0  # connection rounds in a row that left Spheros unconnected
+
+if use_simulated_spheros:
+    sphero_addresses = sphero_sim.simulated_addresses(number_of_simulated_spheros)
+    robot_backend = sphero_sim
+else:
+    robot_backend = sphero_driver
 
 number_of_spheros = len(sphero_addresses)
 
-thread_array = [None] * number_of_spheros
-sphero_array = [None] * number_of_spheros
-for a, address in enumerate(sphero_addresses):
-    sphero_array[a] = sphero_driver.Sphero("Sphero", address)
+# in sharded mode the Spheros live in the worker processes, sphero_array holds stand-ins that forward every call
+sharded_fleet = None
+if number_of_shards > 0:
+    sharded_fleet = ShardedFleet(sphero_addresses, number_of_shards, "sim" if use_simulated_spheros else "driver",
+                                 shard_adapters, roll_dispatch_deadline)
+    sphero_array = sharded_fleet.spheros
+    roll_dispatcher = sharded_fleet.roll_dispatcher
+else:
+    sphero_array = [None] * number_of_spheros
+    for a, address in enumerate(sphero_addresses):
+        sphero_array[a] = robot_backend.Sphero("Sphero", address)
+
+    roll_dispatcher = RollDispatcher(sphero_array, roll_dispatch_deadline)
+
+# connects and sets up all Spheros in parallel and remembers which links failed
+connection_manager = ConnectionManager(sphero_array, connection_timeout)
+sphero_receiving = [False] * number_of_spheros  # the driver's receive thread can only be started once
+
+netlogo_bridge = None
+if netlogo_transport == "socket":
+    netlogo_bridge = ipc_bridge.NetLogoBridgeServer(netlogo_socket_address)
+
+# times every stage of the main loop, the summary is printed after the run
+tick_profiler = TickProfiler(["wait", "read", "parse", "dispatch", "feedback", "write"], tick_profile_export,
+                             ["commands", "roll_latency_mean", "roll_latency_max", "sensor_packets"],
+                             ["roll_latency"], number_of_spheros)
+
+# picks the data stream rate, None = fixed sensor_sample_divisor
+stream_rate_controller = None
+if adapt_stream_rate:
+    stream_rate_controller = StreamRateController(number_of_spheros, stream_link_budget, expected_tick_period,
+                                                  max_frames=sensor_frames_per_packet)
+    sensor_sample_divisor = stream_rate_controller.divisor
+    sensor_frames_per_packet = stream_rate_controller.frames
+
+# filled by the data stream callbacks, read by the main loop through snapshots
+sensor_store = SensorStore(number_of_spheros, sample_period=sensor_sample_divisor / 400.0)
+sensor_filter = ConstantVelocityFilter(number_of_spheros) if filter_sensor_data else None
+
+# wakes the main loop when the NetLogo files change or the whole fleet sent new sensor data
+control_events = ControlEvents(number_of_spheros, ["config.txt", "commandsToRobots.txt"])
+
+# binary log of the run, None = no recording
+run_recorder = None
+if run_record_path is not None:
+    run_recorder = RunRecorder(run_record_path, number_of_spheros, sensor_sample_divisor / 400.0,
+                               extrapolate_sensor_data, filter_sensor_data)
+
+# the data stream callback of all Spheros, writes the samples to the sensor store and the recording
+sensor_data_stream = SensorDataStream(sensor_store, control_events, run_recorder)
+recording_lock = sensor_data_stream.recording_lock
+
+# the parser overwrites its arrays in place, so these names stay valid for the whole run
+netlogo_parser = NetLogoParser(number_of_spheros)
+
+# formats the feedback into templates built for the fleet size and replaces proceed.txt atomically
+feedback_writer = FeedbackWriter(number_of_spheros, compact_feedback)
 
 sphero_internal_headings = [0] * number_of_spheros
-sphero_target_speeds = [0] * number_of_spheros
-sphero_current_speeds = [0] * number_of_spheros
-sphero_target_headings = [0] * number_of_spheros
-sphero_current_headings = [0] * number_of_spheros
+sphero_target_speeds = netlogo_parser.target_speeds
+sphero_target_headings = netlogo_parser.target_headings
 
 first_loop = True
 
-first_sphero_boolean = [True] * number_of_spheros
+first_sphero_boolean = sensor_data_stream.first_pending
 
-first_netlogo_pos = np.zeros((number_of_spheros, 2))
-first_sphero_pos = np.zeros((number_of_spheros, 2))
-X0_YO = np.zeros((number_of_spheros, 2))
-sphero_current_pos = np.zeros((number_of_spheros, 2))
-netlogo_updated_pos = np.zeros((number_of_spheros, 2))
+first_netlogo_pos = netlogo_parser.first_netlogo_pos
+first_sphero_pos = sensor_data_stream.first_positions
 
 
 ########################################################################################################################
@@ -91,41 +202,165 @@ netlogo_updated_pos = np.zeros((number_of_spheros, 2))
 ########################################################################################################################
 ########################################################################################################################
 
-# return the rotation matrix for the input angle
-def rotation_matrix(theta_degrees):
-    theta = np.radians(theta_degrees)
-    c = np.cos(theta)
-    s = np.sin(theta)
-    return np.matrix([[c, -s], [s, c]])
-
-
-# writes the odometry stream data to the global current sphero positions
-def sensor_data_stream_function(callback, sphero_number):
-    global sphero_current_pos, sphero_current_headings, first_sphero_pos, first_sphero_boolean
-
-    # [:] all elements refers to x y here
-    sphero_current_pos[sphero_number][:] = [float(callback.get('ODOM_X')), float(callback.get('ODOM_Y'))]
-
-    vel_x = float(callback.get('VELOCITY_X'))
-    vel_y = float(callback.get('VELOCITY_Y'))
-
-    # convert velocity vector to angle in degrees
-    sphero_current_headings[sphero_number] = math.atan2(vel_x, vel_y) * 180 / math.pi
-
-    # velocities are sent in mm/s => / 10 => cm/s
-    sphero_current_speeds[sphero_number] = math.sqrt(vel_x * vel_x + vel_y * vel_y) / 10
-
-    # save the first position only after config file processing!
-    if first_sphero_boolean[sphero_number] and config_file_processed:
-        first_sphero_pos[sphero_number][:] = sphero_current_pos[sphero_number][:]
-        first_sphero_boolean[sphero_number] = False
-
-
-# execute roll command for sphero with speed and heading
-def calculate_heading_and_roll_function(sphero_number):
-    speed_int = int(round(sphero_target_speeds[sphero_number] * 255 / 100))
-    heading_int = int(round(sphero_internal_headings[sphero_number] + sphero_target_headings[sphero_number])) % 360
-    sphero_array[sphero_number].roll(speed_int, heading_int, 1, False)
+# connects one Sphero if necessary and switches its lights on, the commands fail if the link is dead
+def connect_sphero(sphero_number):
+    sphero = sphero_array[sphero_number]
+    if not sphero.is_connected:
+        sphero.connect()
+        if not sphero.is_connected:
+            return False
+    sphero.set_back_led(255, False)  # SWITCH ON BLUE TAIL LIGHT
+    sphero.set_rgb_led(255, 255, 255, 0, False)  # WHITE = connected
+    sphero.roll(0, sphero_internal_headings[sphero_number], 1, False)  # 0 degree heading, kept after orientation
+    return True
+
+
+# sets up power notification, collision detection and the sensor data stream of one Sphero
+# the link only counts as alive once a data stream packet arrived
+def setup_sphero_streams(sphero_number):
+    sphero = sphero_array[sphero_number]
+    if not sphero.is_connected:
+        return False
+    sensor_packets = sensor_store.counts[sphero_number]
+
+    # setup power notification
+    sphero.set_power_notify(True, False)
+    sphero.add_async_callback(robot_backend.IDCODE['PWR_NOTIFY'],
+                              partial(sphero_helper.power_notify_function,
+                                      sphero_number=sphero_number))
+
+    # setup collision detection
+    # arguments: method, xt, xspd, yt, yspd, ignore_time, response
+    sphero.config_collision_detect(1, 45, 110, 45, 110, 100, False)
+    sphero.add_async_callback(robot_backend.IDCODE['COLLISION'],
+                              partial(collision_function,
+                                      sphero_number=sphero_number))
+
+    # setup sensor data stream
+    sphero.set_all_data_strm(sensor_sample_divisor, sensor_frames_per_packet, 0, False)
+    sphero.add_async_callback(robot_backend.IDCODE['DATA_STRM'],
+                              partial(sensor_data_stream.callback,
+                                      sphero_number=sphero_number))
+    if not sphero_receiving[sphero_number]:
+        sphero.start()
+        sphero_receiving[sphero_number] = True
+
+    health_check_end = time.time() + stream_health_timeout
+    while sensor_store.counts[sphero_number] == sensor_packets:
+        if time.time() > health_check_end:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+# disconnects the given Spheros and replaces their driver objects for a reconnect
+# the receive thread of a driver object ends with its connection and can not be started a second time
+# Spheros whose last step is still stuck in the driver after connection_timeout keep their object,
+# it may still finish connecting
+def reset_spheros(sphero_numbers):
+    connection_manager.wait_idle(sphero_numbers)
+    sphero_numbers = [n for n in sphero_numbers if not connection_manager.busy(n)]
+    sphero_helper.disconnect_spheros([sphero_array[n] for n in sphero_numbers])
+    for sphero_number in sphero_numbers:
+        if sharded_fleet is not None:
+            sphero_array[sphero_number].renew()
+        else:
+            sphero_array[sphero_number] = robot_backend.Sphero("Sphero", sphero_addresses[sphero_number])
+        sphero_receiving[sphero_number] = False
+
+
+# decides about Spheros that failed a connection phase: they are retried for connection_retries rounds,
+# then the user can retry once more, drop them or stop the script
+# dropped Spheros stay in the fleet arrays and keep their NetLogo start position, but get no commands
+# returns True if the failed Spheros should be retried
+def retry_failed_spheros(failed_spheros, rounds):
+    print connection_manager.summary() + "\n"
+    if rounds < connection_retries:
+        return True
+
+    numbers = " ".join(str(f + 1) for f in failed_spheros)
+    while True:
+        switch = ask_user("Spheros " + numbers + " failed " + str(rounds) + """ times. Enter 'r' to retry them,
+                 'd' to drop them and go on without them or 's' to stop the script:\n""", "d")
+        if switch.lower().startswith("r"):
+            return True
+        elif switch.lower().startswith("d"):
+            connection_manager.drop(failed_spheros)
+            roll_dispatcher.skip(failed_spheros)
+            sphero_helper.disconnect_spheros([sphero_array[f] for f in failed_spheros])
+            for f in failed_spheros:
+                first_sphero_boolean[f] = False  # no first position will arrive
+            control_events.exclude(failed_spheros)
+            print "Going on without Spheros " + numbers + ".\n"
+            return False
+        elif switch.lower().startswith("s"):
+            sys.exit("Script stopped, Spheros " + numbers + " could not be set up.")
+
+
+# asks the user on the console, simulated runs answer themselves
+def ask_user(prompt, simulated_answer):
+    if use_simulated_spheros:
+        return simulated_answer
+    return raw_input(prompt)
+
+
+# counts collisions for the tick profile, then lets the helper report them
+def collision_function(callback, sphero_number):
+    if callback.get('Speed') > 0:
+        tick_profiler.count_event("collisions")
+        if run_recorder is not None:
+            run_recorder.record_collision(sphero_number, callback.get('Speed'))
+    sphero_helper.collision_function(callback, sphero_number)
+
+
+# finishes the tick profile record with the Bluetooth counters of this tick
+def end_profiled_tick(number_of_commands):
+    if run_recorder is not None:
+        run_recorder.record_tick(tick_profiler.ticks, number_of_commands)
+    tick_profiler.end_tick(commands=number_of_commands,
+                           roll_latency_mean=roll_dispatcher.last_send_latencies.mean(),
+                           roll_latency_max=roll_dispatcher.last_send_latencies.max(),
+                           roll_latency=roll_dispatcher.last_send_latencies,
+                           sensor_packets=int(sensor_store.counts.sum()))
+
+
+# lets the stream rate controller follow the tick period, packet loss and Bluetooth send latency
+def adjust_stream_rate(number_of_commands):
+    if stream_rate_controller is None:
+        return
+    if stream_rate_controller.update(time.time(), number_of_commands > 0, int(sensor_store.counts.sum()),
+                                     int(sensor_store.dropped.sum()), roll_dispatcher.summed_send_latencies.sum(),
+                                     int(roll_dispatcher.send_counts.sum())):
+        stream_rate_controller.apply(sphero_array, sensor_store)
+
+
+# returns the NetLogo commands that set odometry positions, measured headings and measured speeds
+def netlogo_feedback_commands():
+    # one consistent view of all data streams, taken at the time the feedback is sent
+    if run_recorder is not None:
+        with recording_lock:
+            sensor_snapshot = sensor_store.snapshot(extrapolate=extrapolate_sensor_data, sensor_filter=sensor_filter)
+            run_recorder.record_snapshot(sensor_snapshot.timestamp)
+    else:
+        sensor_snapshot = sensor_store.snapshot(extrapolate=extrapolate_sensor_data, sensor_filter=sensor_filter)
+
+    feedback_commands = feedback_writer.lines(coordinate_transform.to_netlogo(sensor_snapshot.positions),
+                                              coordinate_transform.to_netlogo_headings(sensor_snapshot.headings),
+                                              sensor_snapshot.speeds)
+
+    if run_recorder is not None:
+        values = feedback_writer.values  # rounded like the commands
+        run_recorder.record_feedback(values[:, :2], values[:, 2], values[:, 3], sensor_snapshot.timestamp)
+
+    return feedback_commands
+
+
+# hand roll commands with speed and heading for all spheros to the dispatcher
+def calculate_heading_and_roll_function():
+    speed_ints, heading_ints = roll_arguments(sphero_internal_headings, sphero_target_headings, sphero_target_speeds)
+    roll_dispatcher.submit_all(speed_ints.tolist(), heading_ints.tolist())
+    if run_recorder is not None:
+        run_recorder.record_rolls(speed_ints, heading_ints)
 
 
 ########################################################################################################################
@@ -137,28 +372,44 @@ if __name__ == '__main__':
     # bad practice but necessary to catch previously unknown exceptions
     try:
         while restart:  # in case of BT connection problems, restart from here
-            # pair Spheros via Bluetooth
-            for sphero in sphero_array:
-                # retry connecting until connected
-                while not sphero.is_connected:
-                    sphero.connect()
-                # after connection has been established
-                sphero.set_back_led(255, False)  # SWITCH ON BLUE TAIL LIGHT
-                sphero.set_rgb_led(255, 255, 255, 0, False)  # WHITE = connected
-                sphero.roll(0, 0, 1, False)  # rotate to internal 0 degree heading
+            # pair Spheros via Bluetooth, all at once, after a restart only those whose links failed
+            failed_spheros = connection_manager.run(connect_sphero, connection_manager.failed())
+            if failed_spheros:
+                connect_rounds += 1
+                if retry_failed_spheros(failed_spheros, connect_rounds):
+                    print "Retrying the Spheros that could not be connected. If they keep failing, " \
+                          "check their batteries.\n"
+                    reset_spheros(failed_spheros)
+                    continue
+            else:
+                print connection_manager.summary() + "\n"
+            connect_rounds = 0
 
             # some connections are lost sometimes but don't throw errors, thus ask user
             while True:
                 # todo look into driver code: maybe there is an error that is not caught?
-                switch = raw_input("Are all Spheros a constant white (y/n)?\n")
+                switch = ask_user("Are all Spheros a constant white (y/n)?\n", "y")
                 if switch.lower().startswith("y"):
                     bt_error_restart = False
                     break
                 elif switch.lower().startswith("n"):
+                    numbers = ask_user("""Enter the numbers of the Spheros that are not white, separated by
+                     spaces (all Spheros: press 'Enter'):\n""", "")
+                    try:
+                        restart_spheros = [int(number) - 1 for number in numbers.split()]
+                        if any(number not in range(number_of_spheros) for number in restart_spheros):
+                            raise ValueError()
+                    except ValueError:
+                        print "Please enter numbers between 1 and " + str(number_of_spheros) + ".\n"
+                        continue
+                    if not restart_spheros:
+                        restart_spheros = connection_manager.active()
+
                     print """Restarting Bluetooth setup. If it does not work the next time, try restarting
                     the script, the robots or turn your laptop's Bluetooth on and off!\n"""
                     bt_error_restart = True
-                    sphero_helper.disconnect_spheros(sphero_array)
+                    connection_manager.mark_failed(restart_spheros)
+                    reset_spheros(restart_spheros)
                     break  # first stop while loop, then see continue below to get to restart loop
 
             if bt_error_restart:
@@ -166,14 +417,15 @@ if __name__ == '__main__':
 
             print "Orient spheros along baseline using blue tail lights!\n"
 
-            for k, sphero in enumerate(sphero_array):
+            for k in connection_manager.active():
+                sphero = sphero_array[k]
                 sphero.set_rgb_led(255, 0, 0, 0, False)  # RED = active
                 absolute_heading = 0
                 sphero.set_stablization(1, False)  # enable IMU stabilization
 
                 while True:
-                    relative_heading = raw_input("""Enter adjustment for red sphero (+-180, positive = clockwise,
-                     test heading by entering 0, accept current orientation by pressing 'Enter'):\n""")
+                    relative_heading = ask_user("""Enter adjustment for red sphero (+-180, positive = clockwise,
+                     test heading by entering 0, accept current orientation by pressing 'Enter'):\n""", "")
                     try:
                         absolute_heading += int(relative_heading)
                         absolute_heading %= 360
@@ -197,9 +449,9 @@ if __name__ == '__main__':
                 sphero.set_rgb_led(255, 255, 255, 0, False)  # WHITE = inactive
 
             while True:
-                switch = raw_input(
+                switch = ask_user(
                     """Please place the Spheros according to their matching Netlogo positions. 
-                    To continue, enter 'y'.\n""")
+                    To continue, enter 'y'.\n""", "y")
                 if switch.lower().startswith("y"):
                     break
 
@@ -207,27 +459,16 @@ if __name__ == '__main__':
             # streams are only allowed to be started after orientation!! test!
             # try stop first from previous BT runs?
             # stop old streams, setup up new ones, start new ones!
-            for b, sphero in enumerate(sphero_array):
-                # setup power notification
-                sphero.set_power_notify(True, False)
-                sphero.add_async_callback(sphero_driver.IDCODE['PWR_NOTIFY'],
-                                          partial(sphero_helper.power_notify_function,
-                                                  sphero_number=b))
-
-                # setup collision detection
-                # arguments: method, xt, xspd, yt, yspd, ignore_time, response
-                sphero.config_collision_detect(1, 45, 110, 45, 110, 100, False)
-                sphero.add_async_callback(sphero_driver.IDCODE['COLLISION'],
-                                          partial(sphero_helper.collision_function,
-                                                  sphero_number=b))
-
-                # setup sensor data stream
-                # sample_div=40: divisor of the maximum sensor sampling rate., 20<x<50 recommended
-                sphero.set_all_data_strm(40, 1, 0, False)
-                sphero.add_async_callback(sphero_driver.IDCODE['DATA_STRM'],
-                                          partial(sensor_data_stream_function,
-                                                  sphero_number=b))
-                sphero.start()
+            failed_spheros = connection_manager.run(setup_sphero_streams)
+            stream_rounds = 1
+            while failed_spheros and retry_failed_spheros(failed_spheros, stream_rounds):
+                # the orientation is kept, only the failed links are reconnected and set up again
+                print "Reconnecting the Spheros without data stream.\n"
+                reset_spheros(failed_spheros)
+                connection_manager.run(connect_sphero, failed_spheros)
+                failed_spheros = connection_manager.run(setup_sphero_streams, failed_spheros)
+                stream_rounds += 1
+            print connection_manager.summary() + "\n"
 
             # if Netlogo files still exists from a previous run, delete it first
             try:
@@ -242,113 +483,161 @@ if __name__ == '__main__':
             print """Please go to NetLogo. Adapt the model and environment parameters if necessary and press
              'setup' to generate the config file!\n"""
 
-            # wait for config.txt to exist
-            while not os.path.exists("config.txt"):
-                time.sleep(0.05)  # wait 50ms in between
-            print "NetLogo config file found.\n"
-
-            new_lines_read = 0
-            lines_read = 0
+            if netlogo_bridge is not None:
+                netlogo_bridge.accept()
+                print "NetLogo connected to " + netlogo_socket_address + ".\n"
+            else:
+                # wait for config.txt to exist
+                control_events.wait_for_file("config.txt")
+                print "NetLogo config file found.\n"
 
             while not config_file_processed:
                 # try reading config file and updating globals
-                # execute config file lines
-                with open("config.txt", "r") as txt_file:
-                    for line in txt_file:
-                        try:
-                            exec (line, globals())  # only single command lines in config file
-                        except IndexError:
-                            continue  # happens if more Spheros are set in Netlogo then in Python script, see below
+                # lines the parser does not know (e.g. set_rgb_led for more Spheros than in this script) are skipped
+                if netlogo_bridge is not None:
+                    message_kind, config_lines = netlogo_bridge.receive()
+                    if message_kind != ipc_bridge.CONFIG:
+                        raise ipc_bridge.BridgeException("expected the config from NetLogo, got " + str(message_kind))
+                    netlogo_parser.parse_lines(config_lines)
+                else:
+                    control_events.wait(0)  # events queued so far are about the version read now
+                    with open("config.txt", "r") as txt_file:
+                        netlogo_parser.parse_lines(txt_file)
+
+                number_of_spheros_in_netlogo = netlogo_parser.number_of_spheros_in_netlogo
+                scale = netlogo_parser.scale
+
+                for sphero_number, r, g, b in netlogo_parser.rgb_led_commands:
+                    if not connection_manager.dropped[sphero_number]:
+                        sphero_array[sphero_number].set_rgb_led(r, g, b, 0, False)
+                del netlogo_parser.rgb_led_commands[:]
 
                 if number_of_spheros != number_of_spheros_in_netlogo:
                     print """Config file creation failed. Please try pressing 'setup' again.\n""" \
                         .format(number_of_spheros_in_netlogo, number_of_spheros)
+                    if netlogo_bridge is not None:
+                        netlogo_bridge.reply(ipc_bridge.ERROR, ["number of Spheros differs from the Python script"])
+                    else:
+                        # sleep until NetLogo writes config.txt again instead of parsing the same file over and over
+                        while "config.txt" not in control_events.wait() or not control_events.exists["config.txt"]:
+                            pass
                 else:
                     print "Config file processed.\n"
                     config_file_processed = True
+                    sensor_data_stream.capture_first = True  # the next data stream packets set the first positions
 
-            for e in range(number_of_spheros):
-                rot1 = rotation_matrix(sphero_internal_headings[e])
+            # the internal headings are fixed from here on, so the scaled rotations are only built once per run
+            coordinate_transform = CoordinateTransform(sphero_internal_headings, scale)
 
-                while first_sphero_boolean[e]:
-                    time.sleep(0.05)  # wait 50 ms before checking again if first sphero positions have been set
+            # every data stream callback after the config was processed sets a first position
+            control_events.reset_samples()
+            control_events.wait_until(lambda: not any(first_sphero_boolean))
 
-                X0_YO[e][:] = first_netlogo_pos[e][:] - np.dot(np.divide(rot1, scale), first_sphero_pos[e][:])
+            X0_YO = coordinate_transform.set_origin(first_netlogo_pos, first_sphero_pos)
+            if run_recorder is not None:
+                run_recorder.record_config(first_netlogo_pos, sphero_internal_headings, scale)
+                run_recorder.record_origin(first_sphero_pos)
 
             print "Matrices and vectors set up. Now you can press 'start' in NetLogo!\n"
 
-            # wait for command file to exist
-            while not os.path.exists("commandsToRobots.txt"):
-                time.sleep(0.05)  # wait 50ms in between
-            print "NetLogo command file found.\n"
-
-            new_lines_read = 0
-            lines_read = 0
-
             np.set_printoptions(suppress=True)
 
-            # to stop netlogo model run, the config file will be deleted to save the command file for analysis
-            while os.path.exists("commandsToRobots.txt"):
-                #  keep opening and closing text file, remember number of lines already read and thus skip them
-                try:
-                    with open("commandsToRobots.txt", "r") as txt_file:
-                        if not os.path.exists("config.txt"):
-                            break  # break while loop if NetLogo model run was stopped forcefully
+            if netlogo_bridge is not None:
+                netlogo_bridge.reply(ipc_bridge.OK)  # the config is only acknowledged once NetLogo may start
+                roll_dispatcher.start()
+                sensor_packets_at_start = sensor_store.counts.sum()
 
-                        # jump the lines that have been read already
-                        for i in xrange(lines_read):
-                            txt_file.next()
-
-                        for line in txt_file:
-                            exec (line, globals())
-                            new_lines_read += 1
-
-                        for f in range(number_of_spheros):
-                            thread_array[f] = Thread(target=calculate_heading_and_roll_function,
-                                                     args=[f])
-                        for thread in thread_array:
-                            thread.start()
-
-                        for thread in thread_array:
-                            thread.join()  # wait for threads to finish
-
-                        # calculate updated x y positions
-                        for g in range(number_of_spheros):
-                            rot2 = rotation_matrix(sphero_internal_headings[g])
-                            netlogo_updated_pos[g] = X0_YO[g] + np.dot(np.divide(rot2, scale),
-                                                                       sphero_current_pos[g])
-
-                        # all spheros were given 1 exact roll command and their threads have finished =>
-                        with open("proceed.txt", "w") as proceed_txt_file:  # w = overwrite, a = append
-                            xy = netlogo_updated_pos.transpose().round(2)
-                            xy_command = "(foreach (sort spheros) {0} {1} [[ s x y ] " \
-                                         "-> ask s [ set odometry-pos (list x y) ]])" \
-                                .format(xy[0], xy[1])
-
-                            measured_headings = np.mod(np.array(sphero_current_headings)
-                                                       - np.array(sphero_internal_headings), 360).round(2)
-                            heading_command = "(foreach (sort spheros) {0} [[ s h ] " \
-                                              "-> ask s [ set measured-heading h ]])" \
-                                .format(measured_headings)
-
-                            measured_speeds = np.array(sphero_current_speeds).transpose().round(2)
-                            speed_command = "(foreach (sort spheros) {0} [[ s speed ] " \
-                                            "-> ask s [ set measured-speed speed ]])" \
-                                .format(measured_speeds)
-
-                            proceed_txt_file.write(xy_command + "\n")
-                            proceed_txt_file.write(heading_command + "\n")
-                            proceed_txt_file.write(speed_command + "\n")
-
-                        # if 0, the file was read but no new lines were found
-                        if new_lines_read != 0:
-                            # print "new lines read: " + str(new_lines_read)
-                            lines_read += new_lines_read
-                            # print "total lines read now: " + str(lines_read)
-                            new_lines_read = 0
-                except IOError:
-                    break  # sometimes file deleted between path exists and open command?
+                # every NetLogo request is answered right away, no files and no polling in between
+                while True:
+                    tick_profiler.start_tick()
+                    message_kind, message_lines = netlogo_bridge.receive()
+                    tick_profiler.lap("wait")
+                    if message_kind == ipc_bridge.COMMANDS:
+                        netlogo_parser.parse_lines(message_lines)
+                        tick_profiler.lap("parse")
+                        calculate_heading_and_roll_function()
+                        roll_dispatcher.wait()
+                        tick_profiler.lap("dispatch")
+                        netlogo_bridge.reply(ipc_bridge.OK)
+                        tick_profiler.lap("write")
+                        end_profiled_tick(len(message_lines))
+                        adjust_stream_rate(len(message_lines))
+                    elif message_kind == ipc_bridge.FEEDBACK:
+                        feedback_commands = netlogo_feedback_commands()
+                        tick_profiler.lap("feedback")
+                        netlogo_bridge.reply(ipc_bridge.FEEDBACK, feedback_commands)
+                        tick_profiler.lap("write")
+                        end_profiled_tick(0)
+                        adjust_stream_rate(0)
+                    elif message_kind == ipc_bridge.STOP:
+                        netlogo_bridge.reply(ipc_bridge.OK)
+                        break
+                    elif message_kind is None:
+                        break  # NetLogo closed the connection
+                    else:
+                        netlogo_bridge.reply(ipc_bridge.ERROR, ["unknown message " + message_kind])
+
+                netlogo_bridge.close_connection()
+
+            else:
+                # wait for command file to exist
+                control_events.wait_for_file("commandsToRobots.txt")
+                print "NetLogo command file found.\n"
+
+                command_reader = CommandFileReader("commandsToRobots.txt")  # control_events watches it
+                roll_dispatcher.start()
+                sensor_packets_at_start = sensor_store.counts.sum()
+
+                # to stop netlogo model run, the config file will be deleted to save the command file for analysis
+                while control_events.exists["commandsToRobots.txt"]:
+                    # the reader remembers its offset in the command file and only reads lines appended since last time
+                    try:
+                        if not control_events.exists["config.txt"]:
+                            break  # break while loop if NetLogo model run was stopped forcefully
 
+                        tick_profiler.start_tick()
+                        new_lines = command_reader.read_new_lines()
+                        tick_profiler.lap("read")
+                        if not new_lines:
+                            # no new commands: sleep until NetLogo writes again or stops the run, but refresh
+                            # proceed.txt once the whole fleet sent new sensor data or the refresh interval is over
+                            control_events.reset_samples()
+                            if "commandsToRobots.txt" in control_events.wait(proceed_refresh_interval):
+                                new_lines = command_reader.read_new_lines()
+                        tick_profiler.lap("wait")
+
+                        netlogo_parser.parse_lines(new_lines)
+                        tick_profiler.lap("parse")
+
+                        calculate_heading_and_roll_function()
+                        roll_dispatcher.wait()  # wait for the workers, but not longer than the deadline
+                        tick_profiler.lap("dispatch")
+
+                        feedback_commands = netlogo_feedback_commands()
+                        tick_profiler.lap("feedback")
+
+                        # all spheros were given 1 roll command and their workers have sent it (or the deadline passed)
+                        feedback_writer.write(feedback_commands, "proceed.txt")
+                        tick_profiler.lap("write")
+                        end_profiled_tick(len(new_lines))
+                        adjust_stream_rate(len(new_lines))
+                    except IOError:
+                        break  # sometimes file deleted between path exists and open command?
+
+            roll_dispatcher.stop()
+            print roll_dispatcher.summary() + "\n"
+            print sensor_store.summary() + "\n"
+            if stream_rate_controller is not None:
+                print stream_rate_controller.summary() + "\n"
+            print "Parsed {0} NetLogo lines in {1:.3f} s, rejected {2} malformed lines.\n" \
+                .format(netlogo_parser.lines_parsed, netlogo_parser.parse_time, netlogo_parser.lines_rejected)
+            print tick_profiler.summary() + "\n"
+            print "Main loop woke up {0} times for events and {1} times after a timeout.\n" \
+                .format(control_events.wakeups, control_events.timeouts)
+            if run_recorder is not None:
+                print run_recorder.summary() + "\n"
+            print "Sensor packet rate: {0:.1f} packets/s\n".format(
+                (sensor_store.counts.sum() - sensor_packets_at_start) / max(tick_profiler.elapsed(), 1e-9))
             print "NetLogo model run was stopped.\n"
             restart = False
 
@@ -362,6 +651,15 @@ if __name__ == '__main__':
         traceback.print_exc()
         raise
     finally:
-        sphero_helper.stop_spheros(sphero_array)
+        tick_profiler.close()
+        if run_recorder is not None:
+            run_recorder.close()
+        roll_dispatcher.stop()
+        sphero_helper.stop_spheros([sphero_array[k] for k in connection_manager.active()])
         print "Disconnecting Spheros.\n"
         sphero_helper.disconnect_spheros(sphero_array)
+        if netlogo_bridge is not None:
+            netlogo_bridge.close()
+        if sharded_fleet is not None:
+            sharded_fleet.close()
+        control_events.close()  # after the data streams are off, their callbacks wake the main loop
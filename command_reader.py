@@ -0,0 +1,127 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+TAIL_LENGTH = 64  # bytes CommandFileReader compares to notice a rewritten command file
+
+
+# watches a directory with inotify (Linux only), used to sleep until a file in it changes
+class InotifyWatcher(object):
+    def __init__(self, fd, file_name):
+        self.fd = fd
+        self.file_name = file_name
+
+    # returns None if inotify is not available, callers then fall back to polling
+    @classmethod
+    def create(cls, path):
+        library_name = ctypes.util.find_library("c")
+        if library_name is None:
+            return None
+        try:
+            libc = ctypes.CDLL(library_name, use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+
+        directory = os.path.dirname(os.path.abspath(path))
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        if libc.inotify_add_watch(fd, directory.encode(), mask) < 0:
+            os.close(fd)
+            return None
+        return cls(fd, os.path.basename(path))
+
+    # reads all pending events, returns True if one of them concerns the watched file
+    def drain(self):
+        found = False
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except OSError:
+                return found  # EAGAIN: no more events queued
+            offset = 0
+            while offset + INOTIFY_EVENT_HEADER.size <= len(data):
+                _, _, _, name_length = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+                offset += INOTIFY_EVENT_HEADER.size
+                name = data[offset:offset + name_length].rstrip(b"\0").decode()
+                offset += name_length
+                if name == self.file_name:
+                    found = True
+
+    def close(self):
+        os.close(self.fd)
+
+
+# tails a text file that another process keeps appending lines to (NetLogo's commandsToRobots.txt)
+# the byte offset of the last complete line is remembered, so every read only touches new data
+# and the cost per tick does not grow with the length of the run
+class CommandFileReader(object):
+    def __init__(self, path):
+        self.path = path
+
+        self.offset = 0
+        self.file_id = None  # device and inode
+        self.mtime = None
+        self.tail = ""  # the last bytes before offset, a rewritten file does not end with them anymore
+        self.partial_line = ""
+
+        self.lines_read = 0
+        self.resets = 0  # how often the file was truncated or recreated
+
+    # returns the complete lines appended since the last call, possibly an empty list
+    # an unterminated last line is kept back until NetLogo has written its newline
+    def read_new_lines(self):
+        try:
+            txt_file = open(self.path, "r")
+        except IOError:
+            return []  # file does not exist (yet or anymore)
+
+        with txt_file:
+            stat = os.fstat(txt_file.fileno())
+            file_id = (stat.st_dev, stat.st_ino)
+            if stat.st_size == self.offset and stat.st_mtime == self.mtime and file_id == self.file_id:
+                return []
+            self.mtime = stat.st_mtime
+
+            # an inode can be reused right after the old file was deleted and a truncated file can be rewritten
+            # past the old offset, so the remembered tail is read again with the new data and has to match
+            data = None
+            if file_id == self.file_id and stat.st_size >= self.offset:
+                txt_file.seek(self.offset - len(self.tail))
+                data = txt_file.read()
+                if data.startswith(self.tail):
+                    data = data[len(self.tail):]
+                else:
+                    data = None
+            if data is None:
+                # file was recreated or truncated, start reading from the top again
+                if self.file_id is not None:
+                    self.resets += 1
+                self.file_id = file_id
+                self.offset = 0
+                self.tail = ""
+                self.partial_line = ""
+                txt_file.seek(0)
+                data = txt_file.read()
+
+        self.offset += len(data)
+        self.tail = (self.tail + data)[-TAIL_LENGTH:]
+        lines = (self.partial_line + data).split("\n")
+        self.partial_line = lines.pop()
+
+        lines = [line for line in lines if line.strip()]
+        self.lines_read += len(lines)
+        return lines
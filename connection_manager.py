@@ -0,0 +1,125 @@
+import threading
+import time
+
+
+# connects and configures all Spheros in parallel, every robot in its own thread with its own deadline
+# a failing step is retried with exponential backoff until the deadline, and one unresponsive robot
+# only fails itself instead of blocking the rest of the fleet
+# a step that is still stuck in the driver after its deadline is waited for before the next step for that robot
+# starts, so two calls never work on the same robot at once
+class ConnectionManager(object):
+    def __init__(self, spheros, timeout=20.0, backoff=0.5, max_backoff=8.0):
+        self.spheros = spheros
+        self.timeout = timeout  # s per robot and phase
+        self.backoff = backoff  # s before the first retry, doubled for every further one
+        self.max_backoff = max_backoff
+
+        number_of_spheros = len(spheros)
+        self.healthy = [False] * number_of_spheros
+        self.setup_times = [0.0] * number_of_spheros  # s summed over all phases
+        self.attempts = [0] * number_of_spheros
+        self.errors = [None] * number_of_spheros
+        self.dropped = [False] * number_of_spheros  # given up by the user, left out of all further phases
+        self.threads = [None] * number_of_spheros  # of the last step per robot, may outlive its run()
+
+    # runs step(sphero_number) for the given Spheros (default: all that were not dropped) in parallel
+    # step returns True once the robot is done and False or raises to be retried
+    # returns the numbers of the Spheros that did not succeed before their deadline
+    def run(self, step, sphero_numbers=None, timeout=None):
+        if sphero_numbers is None:
+            sphero_numbers = self.active()
+        timeout = self.timeout if timeout is None else timeout
+
+        results = {}
+        threads = []
+        for sphero_number in sphero_numbers:
+            previous = self.threads[sphero_number] if self.busy(sphero_number) else None
+            thread = threading.Thread(target=self._run_one, args=[step, sphero_number, timeout, results, previous])
+            thread.daemon = True  # a Bluetooth call that never returns must not keep the script alive
+            thread.start()
+            self.threads[sphero_number] = thread
+            threads.append(thread)
+
+        end = time.time() + timeout
+        for thread in threads:
+            thread.join(max(end - time.time(), 0))
+
+        failed = []
+        for sphero_number in sphero_numbers:
+            self.healthy[sphero_number] = results.get(sphero_number, False)
+            if not self.healthy[sphero_number]:
+                failed.append(sphero_number)
+                if self.errors[sphero_number] is None:
+                    self.errors[sphero_number] = "timed out"
+        return failed
+
+    def _run_one(self, step, sphero_number, timeout, results, previous):
+        start = time.time()
+        end = start + timeout
+        delay = self.backoff
+        if previous is not None:
+            previous.join(timeout)
+            if previous.is_alive():
+                self.errors[sphero_number] = "the previous attempt is still running"
+                return
+        self.errors[sphero_number] = None
+
+        while True:
+            self.attempts[sphero_number] += 1
+            try:
+                if step(sphero_number):
+                    results[sphero_number] = True
+                    break
+                self.errors[sphero_number] = "not ready"
+            except (Exception, SystemExit) as e:  # the driver exits its thread on some Bluetooth errors
+                self.errors[sphero_number] = "{0}: {1}".format(type(e).__name__, e)
+
+            if time.time() + delay >= end:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_backoff)
+
+        self.setup_times[sphero_number] += time.time() - start
+
+    # True while the last step started for the Sphero has not returned yet
+    def busy(self, sphero_number):
+        thread = self.threads[sphero_number]
+        return thread is not None and thread.is_alive()
+
+    # waits up to timeout (in s) for the last steps of the given Spheros to return
+    def wait_idle(self, sphero_numbers, timeout=None):
+        end = time.time() + (self.timeout if timeout is None else timeout)
+        for sphero_number in sphero_numbers:
+            if self.busy(sphero_number):
+                self.threads[sphero_number].join(max(end - time.time(), 0))
+
+    # the Spheros whose last phase failed, they are the only ones a restart needs to reconnect
+    def failed(self):
+        return [sphero_number for sphero_number, healthy in enumerate(self.healthy)
+                if not healthy and not self.dropped[sphero_number]]
+
+    # the Spheros that were not dropped
+    def active(self):
+        return [sphero_number for sphero_number, dropped in enumerate(self.dropped) if not dropped]
+
+    # for robots the user gave up on, the rest of the fleet goes on without them
+    def drop(self, sphero_numbers):
+        for sphero_number in sphero_numbers:
+            self.dropped[sphero_number] = True
+            self.healthy[sphero_number] = False
+
+    # for links that look fine to the script but not to the user, e.g. a Sphero that is not white
+    def mark_failed(self, sphero_numbers):
+        for sphero_number in sphero_numbers:
+            self.healthy[sphero_number] = False
+            self.errors[sphero_number] = "marked as failed"
+
+    def summary(self):
+        lines = []
+        for sphero_number in range(len(self.spheros)):
+            lines.append("Sphero {0}: {1} after {2:.2f} s and {3} attempts{4}".format(
+                sphero_number + 1, "ok" if self.healthy[sphero_number] else
+                "DROPPED" if self.dropped[sphero_number] else "FAILED",
+                self.setup_times[sphero_number], self.attempts[sphero_number],
+                "" if self.healthy[sphero_number] else " (" + str(self.errors[sphero_number]) + ")"))
+        return "\n".join(lines)
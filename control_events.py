@@ -0,0 +1,170 @@
+import errno
+import fcntl
+import os
+import select
+import threading
+
+from command_reader import InotifyWatcher
+from tick_profiler import monotonic
+
+
+# wakeup pipes: a thread or process writes a byte to wake another one that blocks in select() on the read end
+def nonblocking_pipe():
+    read_fd, write_fd = os.pipe()
+    for fd in (read_fd, write_fd):
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    return read_fd, write_fd
+
+
+def wake_pipe(fd):
+    try:
+        os.write(fd, b"x")
+    except OSError as e:
+        if e.errno != errno.EAGAIN:  # pipe full: a wakeup is pending anyway
+            raise
+
+
+def drain_pipe(fd):
+    try:
+        while os.read(fd, 4096):
+            pass
+    except OSError:
+        pass  # EAGAIN: drained
+
+
+# lets the main loop sleep until something it is waiting for happened instead of polling with sleeps:
+# one of the NetLogo files was created, changed or deleted (inotify, polling without it)
+# or every Sphero has sent a sensor sample since the last reset_samples()
+# driver threads wake the main loop by writing to a pipe, so the main loop only ever blocks in select()
+class ControlEvents(object):
+    def __init__(self, number_of_spheros, file_names, poll_interval=0.005):
+        self.poll_interval = poll_interval  # s, only used to check the files when inotify is not available
+
+        self.wakeup_read, self.wakeup_write = nonblocking_pipe()
+
+        self.watchers = {}
+        self.exists = {}
+        self.mtimes = {}  # only used to notice changes when polling
+        for file_name in file_names:
+            self.watchers[file_name] = InotifyWatcher.create(file_name)
+            self.exists[file_name] = os.path.exists(file_name)
+            self.mtimes[file_name] = self._mtime(file_name)
+        self.polling = any(watcher is None for watcher in self.watchers.values())
+
+        self.lock = threading.Lock()
+        self.fresh = [False] * number_of_spheros
+        self.missing_samples = number_of_spheros
+        self.reset_fresh = [False] * number_of_spheros  # True for Spheros that are not waited for
+
+        self.wakeups = 0
+        self.timeouts = 0
+        self.closed = False
+
+    # called from the driver threads for every sensor sample, wakes the main loop once the whole fleet reported
+    def notify_sample(self, sphero_number):
+        if self.fresh[sphero_number]:
+            return
+        with self.lock:
+            if self.fresh[sphero_number]:
+                return
+            self.fresh[sphero_number] = True
+            self.missing_samples -= 1
+            if self.missing_samples == 0 and not self.closed:  # late samples arrive until the streams are off
+                self.wake()
+
+    # True once every Sphero has sent a sample since the last reset_samples()
+    def samples_fresh(self):
+        return self.missing_samples == 0
+
+    # call from the thread that waits, a wakeup still pending for the old samples is discarded
+    def reset_samples(self):
+        with self.lock:
+            self.fresh = list(self.reset_fresh)
+            self.missing_samples = self.reset_fresh.count(False)
+            self._drain_wakeups()
+
+    # stops waiting for samples of the given Spheros, e.g. of dropped ones that never send any
+    def exclude(self, sphero_numbers):
+        for sphero_number in sphero_numbers:
+            self.reset_fresh[sphero_number] = True
+        self.reset_samples()
+
+    def _drain_wakeups(self):
+        drain_pipe(self.wakeup_read)
+
+    # wakes up wait(), safe to call from any thread
+    def wake(self):
+        wake_pipe(self.wakeup_write)
+
+    # blocks until a watched file changed, wake() was called or the timeout (in s, None = forever) ran out
+    # returns the names of the files that changed, their state is in self.exists
+    # the watches cover whole directories, events about other files in them (e.g. the proceed.txt this loop
+    # writes) are drained and the wait goes on, so an idle loop sleeps until the timeout
+    def wait(self, timeout=None):
+        end = None if timeout is None else monotonic() + timeout
+        fds = [self.wakeup_read] + [watcher.fd for watcher in self.watchers.values() if watcher is not None]
+        while True:
+            remaining = None if end is None else max(end - monotonic(), 0)
+            if self.polling and (remaining is None or remaining > self.poll_interval):
+                remaining = self.poll_interval
+            readable, _, _ = select.select(fds, [], [], remaining)
+
+            woken = self.wakeup_read in readable
+            if woken:
+                self._drain_wakeups()
+
+            changed = []
+            for file_name, watcher in self.watchers.items():
+                if watcher is None or watcher.fd in readable and watcher.drain():
+                    exists = os.path.exists(file_name)
+                    if watcher is None:
+                        mtime = self._mtime(file_name)
+                        if exists != self.exists[file_name] or mtime != self.mtimes[file_name]:
+                            changed.append(file_name)
+                        self.mtimes[file_name] = mtime
+                    else:
+                        changed.append(file_name)
+                    self.exists[file_name] = exists
+
+            if woken or changed:
+                self.wakeups += 1
+                return changed
+            if end is not None and monotonic() >= end:
+                self.timeouts += 1
+                return changed
+
+    @staticmethod
+    def _mtime(file_name):
+        try:
+            return os.stat(file_name).st_mtime
+        except OSError:
+            return None
+
+    # blocks until the file exists (or, with exists=False, until it is gone)
+    def wait_for_file(self, file_name, exists=True, timeout=None):
+        return self.wait_until(lambda: self.exists[file_name] == exists, timeout)
+
+    # blocks until the condition is true, it is checked whenever an event arrived
+    # returns False if the timeout (in s, None = forever) ran out first
+    def wait_until(self, condition, timeout=None):
+        end = None if timeout is None else monotonic() + timeout
+        self.wait(0)  # events that are already queued, e.g. for files deleted before this call
+        while not condition():
+            if end is None:
+                self.wait()
+                continue
+            remaining = end - monotonic()
+            if remaining <= 0:
+                return False
+            self.wait(remaining)
+        return True
+
+    def close(self):
+        for watcher in self.watchers.values():
+            if watcher is not None:
+                watcher.close()
+        self.watchers = {}
+        with self.lock:  # notify_sample() must not write to the closed pipe or a file that reuses its number
+            self.closed = True
+            os.close(self.wakeup_read)
+            os.close(self.wakeup_write)
@@ -0,0 +1,58 @@
+import numpy as np
+
+
+# returns the stacked (N,2,2) rotation matrices for the input angles
+def rotation_matrices(theta_degrees):
+    theta = np.radians(np.asarray(theta_degrees, dtype=float))
+    c = np.cos(theta)
+    s = np.sin(theta)
+    rotations = np.empty((len(theta), 2, 2))
+    rotations[:, 0, 0] = c
+    rotations[:, 0, 1] = -s
+    rotations[:, 1, 0] = s
+    rotations[:, 1, 1] = c
+    return rotations
+
+
+# converts Sphero velocity vectors (mm/s) to headings in degrees and speeds in cm/s for the whole fleet
+def velocities_to_headings_and_speeds(vel_x, vel_y, headings_out=None, speeds_out=None):
+    headings = np.degrees(np.arctan2(vel_x, vel_y, out=headings_out), out=headings_out)
+    speeds = np.hypot(vel_x, vel_y, out=speeds_out)
+    speeds /= 10
+    return headings, speeds
+
+
+# maps Sphero odometry to NetLogo coordinates for the whole fleet at once
+# the scaled rotations only depend on the internal headings, which are fixed after calibration,
+# so they are built once and every tick is a single batched matrix product into a preallocated buffer
+class CoordinateTransform(object):
+    def __init__(self, internal_headings, scale):
+        self.internal_headings = np.array(internal_headings, dtype=float)
+        self.scaled_rotations = rotation_matrices(self.internal_headings) / scale
+
+        number_of_spheros = len(self.internal_headings)
+        self.origin = np.zeros((number_of_spheros, 2))  # X0_YO: NetLogo position of the odometry origin
+        self.netlogo_pos = np.zeros((number_of_spheros, 2))
+        self.measured_headings = np.zeros(number_of_spheros)
+
+    # rotates and scales odometry positions (N,2) without the origin offset
+    def rotate(self, sphero_pos, out=None):
+        return np.einsum("nij,nj->ni", self.scaled_rotations, sphero_pos, out=out)
+
+    # sets the origin so that the first odometry positions map to the first NetLogo positions
+    def set_origin(self, first_netlogo_pos, first_sphero_pos):
+        self.rotate(first_sphero_pos, out=self.origin)
+        np.subtract(first_netlogo_pos, self.origin, out=self.origin)
+        return self.origin
+
+    # returns the NetLogo positions for the current odometry positions, the buffer is reused every call
+    def to_netlogo(self, sphero_pos):
+        self.rotate(sphero_pos, out=self.netlogo_pos)
+        self.netlogo_pos += self.origin
+        return self.netlogo_pos
+
+    # returns the measured headings relative to the calibrated 0 degree heading (0-360), reusing a buffer
+    def to_netlogo_headings(self, sphero_headings):
+        np.subtract(sphero_headings, self.internal_headings, out=self.measured_headings)
+        np.mod(self.measured_headings, 360, out=self.measured_headings)
+        return self.measured_headings
@@ -0,0 +1,80 @@
+import os
+import re
+
+import numpy as np
+
+# columns of the feedback values
+NETLOGO_X = 0
+NETLOGO_Y = 1
+MEASURED_HEADING = 2
+MEASURED_SPEED = 3
+FEEDBACK_FIELDS = 4
+
+FEEDBACK_LIST_PATTERN = re.compile(r"\[([-0-9.eE+ ,]*)\]")
+
+
+# formats the feedback for NetLogo (proceed.txt or FEEDBACK messages) and publishes proceed.txt atomically
+# the number templates are built once for the fleet size, so a tick only rounds into a reusable buffer and
+# fills one template per line, with fixed precision and without line breaks for any number of Spheros
+# compact = False: the three foreach commands NetLogo runs as they are
+# compact = True: one list with x, y, heading and speed per Sphero for the apply-feedback procedure of the model
+class FeedbackWriter(object):
+    def __init__(self, number_of_spheros, compact=False, precision=2):
+        self.compact = compact
+        self.precision = precision
+        self.values = np.zeros((number_of_spheros, FEEDBACK_FIELDS))  # as sent, rounded to the precision
+
+        number = "%.{0}f".format(precision)
+        numbers = "[" + " ".join([number] * number_of_spheros) + "]"
+        self.xy_template = "(foreach (sort spheros) " + numbers + " " + numbers + \
+                           " [[ s x y ] -> ask s [ set odometry-pos (list x y) ]])"
+        self.heading_template = "(foreach (sort spheros) " + numbers + \
+                                " [[ s h ] -> ask s [ set measured-heading h ]])"
+        self.speed_template = "(foreach (sort spheros) " + numbers + \
+                              " [[ s speed ] -> ask s [ set measured-speed speed ]])"
+        self.compact_template = "[" + " ".join([number] * (number_of_spheros * FEEDBACK_FIELDS)) + "]"
+
+        self.files_written = 0
+
+    # returns the feedback lines for NetLogo positions (N,2), measured headings and speeds
+    def lines(self, netlogo_pos, measured_headings, measured_speeds):
+        values = self.values
+        values[:, NETLOGO_X:NETLOGO_Y + 1] = netlogo_pos
+        values[:, MEASURED_HEADING] = measured_headings
+        values[:, MEASURED_SPEED] = measured_speeds
+        np.round(values, self.precision, out=values)
+
+        if self.compact:
+            return [self.compact_template % tuple(values.ravel().tolist())]
+        return [self.xy_template % tuple(values[:, NETLOGO_X].tolist() + values[:, NETLOGO_Y].tolist()),
+                self.heading_template % tuple(values[:, MEASURED_HEADING].tolist()),
+                self.speed_template % tuple(values[:, MEASURED_SPEED].tolist())]
+
+    # writes the lines to a temporary file and renames it, so NetLogo never sees a half written file
+    def write(self, lines, path="proceed.txt"):
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "w") as txt_file:
+            txt_file.write("\n".join(lines) + "\n")
+        os.rename(temporary_path, path)  # atomic on POSIX, replaces a proceed.txt NetLogo did not read yet
+        self.files_written += 1
+
+
+# reads feedback lines in either format back into an (N,4) array like FeedbackWriter.values
+# values missing from the lines are NaN, used by the stand-in NetLogo clients
+def parse_feedback_lines(lines, number_of_spheros):
+    values = np.full((number_of_spheros, FEEDBACK_FIELDS), np.nan)
+    for line in lines:
+        lists = [np.array(numbers.replace(",", " ").split(), dtype=float)
+                 for numbers in FEEDBACK_LIST_PATTERN.findall(line)]
+        if any(len(numbers) != number_of_spheros for numbers in lists) and \
+                not (len(lists) == 1 and len(lists[0]) == number_of_spheros * FEEDBACK_FIELDS):
+            continue  # written for a different fleet size
+        if "odometry-pos" in line and len(lists) == 2:
+            values[:, NETLOGO_X], values[:, NETLOGO_Y] = lists
+        elif "measured-heading" in line and len(lists) == 1:
+            values[:, MEASURED_HEADING] = lists[0]
+        elif "measured-speed" in line and len(lists) == 1:
+            values[:, MEASURED_SPEED] = lists[0]
+        elif line.startswith("[") and len(lists) == 1:
+            values[:] = lists[0].reshape(number_of_spheros, FEEDBACK_FIELDS)
+    return values
@@ -0,0 +1,466 @@
+import __builtin__
+import ctypes
+import itertools
+import multiprocessing
+import os
+import select
+import threading
+import time
+from functools import partial
+
+import numpy as np
+
+import sphero_sim
+from control_events import drain_pipe, nonblocking_pipe, wake_pipe
+from roll_dispatcher import RollDispatcher
+from sensor_store import ODOM_X, ODOM_Y, SAMPLE_FIELDS, TIMESTAMP, VELOCITY_X, VELOCITY_Y
+
+DATA_STRM = sphero_sim.IDCODE['DATA_STRM']  # same id code as in sphero_driver
+
+SAMPLE_RING = 8  # samples per Sphero in the shared ring, the coordinator delivers at most SAMPLE_RING - 2 per pump
+
+# per shard roll dispatcher counters in shared memory
+UNCHANGED = 0
+COALESCED = 1
+DROPPED = 2
+DEADLINE_MISSES = 3
+COUNTERS = 4
+
+
+# a driver error of a worker without a builtin type, an IOError like a lost Bluetooth link
+class ShardException(IOError):
+    pass
+
+
+# name of the closest builtin base of an exception type, the coordinator can rebuild it from that
+# e.g. "IOError" for bluetooth.BluetoothError and socket.error, so the callers' lost link handling works
+def builtin_error_name(error_type):
+    for base in error_type.__mro__:
+        if getattr(__builtin__, base.__name__, None) is base:
+            return base.__name__
+    return None
+
+
+# numpy view of a zeroed array in shared memory, worker processes forked afterwards see the same memory
+def shared_zeros(shape, ctype=ctypes.c_double):
+    raw = multiprocessing.RawArray(ctype, int(np.prod(shape)))
+    return np.ctypeslib.as_array(raw).reshape(shape)
+
+
+# splits the addresses into contiguous blocks, one per shard, so every shard owns a slice of the shared arrays
+def shard_slices(number_of_spheros, number_of_shards):
+    bounds = np.linspace(0, number_of_spheros, number_of_shards + 1).round().astype(int)
+    return [slice(int(bounds[s]), int(bounds[s + 1])) for s in range(number_of_shards)]
+
+
+# makes sphero_driver connect through the given local adapter, only affects the process it is called in
+def bind_to_adapter(backend, adapter_address):
+    bluetooth = getattr(backend, "bluetooth", None)
+    if bluetooth is None:
+        return False  # simulated Spheros have no adapter
+
+    class AdapterSocket(bluetooth.BluetoothSocket):
+        def connect(self, address):
+            self.bind((adapter_address, 0))
+            return bluetooth.BluetoothSocket.connect(self, address)
+
+    bluetooth.BluetoothSocket = AdapterSocket
+    return True
+
+
+# arrays all shards and the coordinator share, created before the workers are forked
+class SharedFleetState(object):
+    def __init__(self, number_of_spheros, number_of_shards):
+        # commands: written by the coordinator, the generation tells the workers there is a new batch
+        self.speeds = shared_zeros(number_of_spheros)
+        self.headings = shared_zeros(number_of_spheros)
+        self.command_generation = shared_zeros(1, ctypes.c_int64)
+        self.completed_generation = shared_zeros(number_of_shards, ctypes.c_int64)
+
+        # sensor samples: every worker writes the rows of its Spheros, the count publishes a sample
+        self.samples = shared_zeros((number_of_spheros, SAMPLE_RING, SAMPLE_FIELDS))
+        self.sample_counts = shared_zeros(number_of_spheros, ctypes.c_int64)
+
+        # roll dispatcher statistics, the workers' dispatchers write into their slices directly
+        self.last_send_latencies = shared_zeros(number_of_spheros)
+        self.max_send_latencies = shared_zeros(number_of_spheros)
+        self.summed_send_latencies = shared_zeros(number_of_spheros)
+        self.send_counts = shared_zeros(number_of_spheros, ctypes.c_int64)
+        self.skipped = shared_zeros(number_of_spheros, ctypes.c_int8)  # dropped Spheros, see RollDispatcher.skip
+        self.counters = shared_zeros((number_of_shards, COUNTERS), ctypes.c_int64)
+
+
+########################################################################################################################
+# Worker process
+########################################################################################################################
+
+# owns the Spheros of one shard: runs their driver objects, a roll dispatcher and the sensor callbacks
+class ShardWorker(object):
+    def __init__(self, shard_number, rows, addresses, backend, state, connection, wakeup_read, ack_write,
+                 sample_write, deadline):
+        self.shard_number = shard_number
+        self.rows = rows  # slice of the fleet arrays this shard owns
+        self.state = state
+        self.connection = connection
+        self.send_lock = threading.Lock()
+        self.wakeup_read = wakeup_read
+        self.ack_write = ack_write
+        self.sample_write = sample_write
+
+        self.backend = backend
+        self.addresses = addresses
+        self.spheros = [backend.Sphero("Sphero", address) for address in addresses]
+        self.roll_dispatcher = RollDispatcher(self.spheros, deadline)
+        for name in ("last_send_latencies", "max_send_latencies", "summed_send_latencies", "send_counts",
+                     "skipped"):
+            setattr(self.roll_dispatcher, name, getattr(state, name)[rows])
+        self.dispatching = False
+        self.coordinator_pid = os.getppid()
+
+    def run(self):
+        command_thread = threading.Thread(target=self._follow_commands, name="shard-commands")
+        command_thread.daemon = True
+        command_thread.start()
+
+        while True:
+            try:
+                if not self.connection.poll(1.0):
+                    if os.getppid() != self.coordinator_pid:
+                        break  # coordinator died without stopping this shard
+                    continue
+                message = self.connection.recv()
+            except (EOFError, IOError):
+                break  # coordinator is gone
+            if message[0] == "stop":
+                break
+            # every request runs in its own thread, so e.g. slow connects of several Spheros overlap
+            request = threading.Thread(target=self._handle, args=message)
+            request.daemon = True
+            request.start()
+
+        self.roll_dispatcher.stop()
+
+    def _send(self, message):
+        with self.send_lock:
+            self.connection.send(message)
+
+    def _handle(self, kind, request_id, local_index, name, arguments):
+        try:
+            if kind == "get":
+                result = getattr(self.spheros[local_index], name)
+            elif kind == "register":
+                result = self._register(local_index, arguments[0])
+            elif kind == "dispatch":
+                result = self._dispatch(arguments[0])
+            elif kind == "renew":
+                result = self._renew(local_index)
+            else:
+                result = getattr(self.spheros[local_index], name)(*arguments)
+            self._send(("reply", request_id, result, None))
+        except (Exception, SystemExit) as e:  # the driver exits its thread on some Bluetooth errors
+            message = type(e).__name__ + ": " + str(e)
+            self._send(("reply", request_id, None, (builtin_error_name(type(e)), message)))
+
+    # data stream samples go to the shared ring, all other callbacks are forwarded to the coordinator
+    def _register(self, local_index, callback_type):
+        if callback_type == DATA_STRM:
+            callback = partial(self._write_sample, self.rows.start + local_index)
+        else:
+            callback = partial(self._forward_event, self.rows.start + local_index, callback_type)
+        self.spheros[local_index].add_async_callback(callback_type, callback)
+
+    def _write_sample(self, sphero_number, callback):
+        count = self.state.sample_counts[sphero_number]
+        sample = self.state.samples[sphero_number, count % SAMPLE_RING]
+        sample[TIMESTAMP] = time.time()
+        sample[ODOM_X] = callback.get('ODOM_X')
+        sample[ODOM_Y] = callback.get('ODOM_Y')
+        sample[VELOCITY_X] = callback.get('VELOCITY_X')
+        sample[VELOCITY_Y] = callback.get('VELOCITY_Y')
+        self.state.sample_counts[sphero_number] = count + 1  # publish
+        wake_pipe(self.sample_write)
+
+    # a fresh driver object for a reconnect, the receive thread of the old one can not be started again
+    # the roll dispatcher shares the list and picks the new object up with the next command
+    def _renew(self, local_index):
+        self.spheros[local_index] = self.backend.Sphero("Sphero", self.addresses[local_index])
+
+    def _forward_event(self, sphero_number, callback_type, callback):
+        self._send(("event", sphero_number, callback_type, callback))
+
+    def _dispatch(self, enable):
+        if enable and not self.dispatching:
+            self.roll_dispatcher.start()
+        elif not enable and self.dispatching:
+            self.roll_dispatcher.stop()
+        self.dispatching = enable
+
+    # hands every new command batch to the roll dispatcher and acknowledges it once it was sent
+    def _follow_commands(self):
+        completed = 0
+        while True:
+            select.select([self.wakeup_read], [], [])
+            drain_pipe(self.wakeup_read)
+            generation = int(self.state.command_generation[0])
+            if generation == completed or not self.dispatching:
+                continue
+            speeds = self.state.speeds[self.rows].astype(int).tolist()
+            headings = self.state.headings[self.rows].astype(int).tolist()
+            self.roll_dispatcher.submit_all(speeds, headings)
+            self.roll_dispatcher.wait()
+
+            dispatcher = self.roll_dispatcher
+            self.state.counters[self.shard_number] = [dispatcher.unchanged, dispatcher.coalesced,
+                                                      dispatcher.dropped, dispatcher.deadline_misses]
+            completed = generation
+            self.state.completed_generation[self.shard_number] = generation
+            wake_pipe(self.ack_write)
+
+
+def _run_worker(shard_number, rows, addresses, state, connection, wakeup_read, ack_write, sample_write, deadline,
+                adapter, backend_name):
+    if backend_name == "driver":
+        from sphero_driver import sphero_driver as backend
+    else:
+        backend = sphero_sim
+    if adapter:
+        bind_to_adapter(backend, adapter)
+    worker = ShardWorker(shard_number, rows, addresses, backend, state, connection, wakeup_read, ack_write,
+                         sample_write, deadline)
+    worker.run()
+
+
+########################################################################################################################
+# Coordinator side
+########################################################################################################################
+
+# stands in for a Sphero of a shard in the coordinator process, every call is executed by the worker
+# that owns the robot, so bidirectional.py's setup code works unchanged
+class RemoteSphero(object):
+    def __init__(self, shard, local_index):
+        self.shard = shard
+        self.local_index = local_index
+
+    @property
+    def is_connected(self):
+        return self.shard.request("get", self.local_index, "is_connected")
+
+    def add_async_callback(self, callback_type, callback):
+        self.shard.fleet.callbacks[(self.shard.rows.start + self.local_index, callback_type)] = callback
+        self.shard.request("register", self.local_index, None, callback_type)
+
+    def remove_async_callback(self, callback_type):
+        del self.shard.fleet.callbacks[(self.shard.rows.start + self.local_index, callback_type)]
+        self.shard.request("call", self.local_index, "remove_async_callback", callback_type)
+
+    # replaces the driver object in the worker, see ShardWorker._renew
+    def renew(self):
+        self.shard.request("renew", self.local_index, None)
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return partial(self.shard.request, "call", self.local_index, name)
+
+
+# connection of the coordinator to one worker process
+class Shard(object):
+    def __init__(self, fleet, shard_number, rows, connection, process, wakeup_write):
+        self.fleet = fleet
+        self.shard_number = shard_number
+        self.rows = rows
+        self.connection = connection
+        self.process = process
+        self.wakeup_write = wakeup_write
+
+        self.send_lock = threading.Lock()
+        self.pending = {}  # request id => [event, result, error]
+        self.request_ids = itertools.count()
+        self.running = True
+
+        self.reader = threading.Thread(target=self._read, name="shard-" + str(shard_number))
+        self.reader.daemon = True
+        self.reader.start()
+
+    # sends a request to the worker and blocks until its reply, errors of the worker are raised here
+    def request(self, kind, local_index, name, *arguments):
+        if not self.running:
+            # like a lost Bluetooth link, so the callers' error handling works for dead shards too
+            raise AttributeError("shard " + str(self.shard_number) + " is not running")
+        request_id = next(self.request_ids)
+        waiting = [threading.Event(), None, None]
+        self.pending[request_id] = waiting
+        with self.send_lock:
+            self.connection.send((kind, request_id, local_index, name, arguments))
+        waiting[0].wait()
+
+        if waiting[2] is not None:
+            error_name, message = waiting[2]
+            error_type = getattr(__builtin__, error_name, None) if error_name else None
+            if not isinstance(error_type, type) or not issubclass(error_type, Exception) or \
+                    issubclass(error_type, EnvironmentError):
+                error_type = ShardException  # also for SystemExit of the driver, it must not end this process
+            raise error_type(message)
+        return waiting[1]
+
+    def _read(self):
+        while True:
+            try:
+                message = self.connection.recv()
+            except (EOFError, IOError):
+                break
+            if message[0] == "reply":
+                _, request_id, result, error = message
+                waiting = self.pending.pop(request_id)
+                waiting[1], waiting[2] = result, error
+                waiting[0].set()
+            else:
+                _, sphero_number, callback_type, data = message
+                callback = self.fleet.callbacks.get((sphero_number, callback_type))
+                if callback is not None:
+                    callback(data)
+
+        self.running = False
+        for waiting in self.pending.values():
+            waiting[2] = ("AttributeError", "shard " + str(self.shard_number) + " stopped")
+            waiting[0].set()
+
+    def stop(self):
+        if self.running:
+            with self.send_lock:
+                self.connection.send(("stop",))
+        self.process.join(5.0)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+# roll dispatch for a sharded fleet with the interface of RollDispatcher
+# a tick costs one shared memory write of all commands and one wakeup byte per shard
+class ShardedRollDispatcher(object):
+    def __init__(self, fleet):
+        self.fleet = fleet
+        state = fleet.state
+        self.last_send_latencies = state.last_send_latencies
+        self.max_send_latencies = state.max_send_latencies
+        self.summed_send_latencies = state.summed_send_latencies
+        self.send_counts = state.send_counts
+        self.deadline = fleet.deadline
+        self.deadline_misses = 0
+
+    def start(self):
+        for shard in self.fleet.shards:
+            shard.request("dispatch", None, None, True)
+
+    def stop(self):
+        for shard in self.fleet.shards:
+            try:
+                shard.request("dispatch", None, None, False)
+            except (AttributeError, IOError):
+                continue  # shard already stopped
+
+    # the workers' dispatchers read the shared flags with their next batch
+    def skip(self, sphero_numbers):
+        self.fleet.state.skipped[list(sphero_numbers)] = True
+
+    def submit_all(self, speeds, headings):
+        state = self.fleet.state
+        state.speeds[:] = speeds
+        state.headings[:] = headings
+        state.command_generation[0] += 1  # publish
+        for shard in self.fleet.shards:
+            wake_pipe(shard.wakeup_write)
+
+    # blocks until every shard sent its part of the last batch or the deadline (in s) ran out
+    def wait(self, timeout=None):
+        state = self.fleet.state
+        end = time.time() + (self.deadline if timeout is None else timeout)
+        while np.any(state.completed_generation < state.command_generation[0]):
+            remaining = end - time.time()
+            if remaining <= 0:
+                self.deadline_misses += 1
+                return False
+            readable, _, _ = select.select([self.fleet.ack_read], [], [], remaining)
+            if readable:
+                drain_pipe(self.fleet.ack_read)
+        return True
+
+    def summary(self):
+        counters = self.fleet.state.counters.sum(axis=0)
+        lines = ["Roll commands: {0} sent, {1} unchanged, {2} coalesced, {3} dropped, {4} deadline misses "
+                 "({5} in the shards)".format(int(self.send_counts.sum()), counters[UNCHANGED],
+                                               counters[COALESCED], counters[DROPPED], self.deadline_misses,
+                                               counters[DEADLINE_MISSES])]
+        for sphero_number in range(len(self.send_counts)):
+            count = max(self.send_counts[sphero_number], 1)
+            lines.append("Sphero {0}: mean send latency {1:.1f} ms, max {2:.1f} ms"
+                         .format(sphero_number + 1, 1000 * self.summed_send_latencies[sphero_number] / count,
+                                 1000 * self.max_send_latencies[sphero_number]))
+        return "\n".join(lines)
+
+
+# splits the fleet over worker processes, each one optionally bound to its own Bluetooth adapter
+# backend is "driver" for sphero_driver or "sim" for simulated Spheros, adapters holds one local adapter
+# address (or None) per shard
+class ShardedFleet(object):
+    def __init__(self, addresses, number_of_shards, backend="driver", adapters=(), deadline=0.1):
+        number_of_spheros = len(addresses)
+        number_of_shards = max(min(number_of_shards, number_of_spheros), 1)
+        self.deadline = deadline
+        self.state = SharedFleetState(number_of_spheros, number_of_shards)
+        self.callbacks = {}  # (sphero number, callback type) => callback in this process
+
+        self.ack_read, ack_write = nonblocking_pipe()
+        self.sample_read, sample_write = nonblocking_pipe()
+
+        self.shards = []
+        for shard_number, rows in enumerate(shard_slices(number_of_spheros, number_of_shards)):
+            adapter = adapters[shard_number] if shard_number < len(adapters) else None
+            wakeup_read, wakeup_write = nonblocking_pipe()
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=_run_worker, name="shard-" + str(shard_number),
+                args=(shard_number, rows, addresses[rows], self.state, worker_connection, wakeup_read, ack_write,
+                      sample_write, deadline, adapter, backend))
+            process.daemon = True
+            process.start()
+            worker_connection.close()
+            os.close(wakeup_read)
+            self.shards.append(Shard(self, shard_number, rows, connection, process, wakeup_write))
+        os.close(ack_write)
+        os.close(sample_write)
+
+        self.spheros = [RemoteSphero(shard, local_index)
+                        for shard in self.shards for local_index in range(shard.rows.stop - shard.rows.start)]
+        self.roll_dispatcher = ShardedRollDispatcher(self)
+
+        self.delivered = np.zeros(number_of_spheros, dtype=np.int64)
+        self.pumping = True
+        self.pump = threading.Thread(target=self._pump_samples, name="shard-samples")
+        self.pump.daemon = True
+        self.pump.start()
+
+    # delivers the new samples of all shards to the DATA_STRM callbacks registered in this process, oldest first
+    # with the time the worker received them, so the gap and age statistics do not include the pump delay
+    def _pump_samples(self):
+        state = self.state
+        while self.pumping:
+            readable, _, _ = select.select([self.sample_read], [], [], 0.1)
+            if readable:
+                drain_pipe(self.sample_read)
+            counts = state.sample_counts.copy()
+            new = np.minimum(counts - self.delivered, SAMPLE_RING - 2)
+            for sphero_number in np.flatnonzero(new):
+                callback = self.callbacks.get((sphero_number, DATA_STRM))
+                for count in range(counts[sphero_number] - new[sphero_number], counts[sphero_number]):
+                    sample = state.samples[sphero_number, count % SAMPLE_RING]
+                    if callback is not None:
+                        callback({'ODOM_X': sample[ODOM_X], 'ODOM_Y': sample[ODOM_Y],
+                                  'VELOCITY_X': sample[VELOCITY_X], 'VELOCITY_Y': sample[VELOCITY_Y],
+                                  'TIMESTAMP': float(sample[TIMESTAMP])})
+            self.delivered = counts
+
+    def close(self):
+        self.pumping = False
+        self.pump.join()
+        for shard in self.shards:
+            shard.stop()
@@ -0,0 +1,287 @@
+#!/usr/bin/python
+
+import argparse
+import time
+
+import numpy as np
+
+
+# slider defaults and world size of bidirectional.nlogo, in patch units and degrees
+class FlockingParameters(object):
+    def __init__(self, visibility=15.0, visibility_cone=340.0, min_separation=5.0, max_separate_turn=2.0,
+                 max_align_turn=6.0, max_cohere_turn=2.0, max_center_turn=16.0, border_avoidance_distance=10.0,
+                 wiggle_degrees=10.0, min_pxcor=-26, max_pxcor=25, min_pycor=-26, max_pycor=25,
+                 start_percent_speed=15.0):
+        self.visibility = visibility
+        self.visibility_cone = visibility_cone
+        self.min_separation = min_separation
+        self.max_separate_turn = max_separate_turn
+        self.max_align_turn = max_align_turn
+        self.max_cohere_turn = max_cohere_turn
+        self.max_center_turn = max_center_turn
+        self.border_avoidance_distance = border_avoidance_distance
+        self.wiggle_degrees = wiggle_degrees
+        self.min_pxcor = min_pxcor
+        self.max_pxcor = max_pxcor
+        self.min_pycor = min_pycor
+        self.max_pycor = max_pycor
+        self.start_percent_speed = start_percent_speed
+
+
+# NetLogo's subtract-headings: smallest signed angle from h2 to h1, in (-180, 180]
+def subtract_headings(h1, h2):
+    difference = np.mod(np.asarray(h1) - h2, 360.0)
+    return np.where(difference > 180, difference - 360, difference)
+
+
+# NetLogo's turn-at-most, for arrays of headings, turns and limits
+def turn_at_most(headings, turns, max_turns):
+    return np.mod(headings + np.clip(turns, -max_turns, max_turns), 360.0)
+
+
+# NetLogo's atan x y: heading in degrees, clockwise from north
+def netlogo_atan(x, y):
+    return np.mod(np.degrees(np.arctan2(x, y)), 360.0)
+
+
+# uniform grid with cells as large as the search radius, so all neighbors within it are in the 3 x 3 cells around
+# the agents are sorted by cell once per query, then the candidate pairs of every cell offset are built with
+# array operations only, which keeps the work linear in agents times neighbors instead of quadratic
+class SpatialGrid(object):
+    def __init__(self, positions, cell_size):
+        self.positions = positions
+        self.cell_size = cell_size
+
+        cells = np.floor(positions / cell_size).astype(np.int64)
+        self.cell_min = cells.min(axis=0) if len(cells) else np.zeros(2, dtype=np.int64)
+        cells -= self.cell_min
+        self.cells = cells
+        self.shape = cells.max(axis=0) + 1 if len(cells) else np.ones(2, dtype=np.int64)
+
+        cell_ids = cells[:, 0] * self.shape[1] + cells[:, 1]
+        self.order = np.argsort(cell_ids, kind="mergesort")
+        sorted_ids = cell_ids[self.order]
+        all_ids = np.arange(self.shape[0] * self.shape[1])
+        self.cell_start = np.searchsorted(sorted_ids, all_ids, side="left")
+        self.cell_end = np.searchsorted(sorted_ids, all_ids, side="right")
+
+    # returns (i, j, distance) for all ordered pairs i != j closer than radius (radius <= cell_size)
+    def pairs_within(self, radius):
+        number_of_agents = len(self.positions)
+        agents = np.arange(number_of_agents)
+        i_parts, j_parts = [], []
+
+        for offset_x in (-1, 0, 1):
+            for offset_y in (-1, 0, 1):
+                neighbor_x = self.cells[:, 0] + offset_x
+                neighbor_y = self.cells[:, 1] + offset_y
+                valid = (neighbor_x >= 0) & (neighbor_x < self.shape[0]) & \
+                        (neighbor_y >= 0) & (neighbor_y < self.shape[1])
+                neighbor_ids = neighbor_x[valid] * self.shape[1] + neighbor_y[valid]
+                starts = self.cell_start[neighbor_ids]
+                counts = self.cell_end[neighbor_ids] - starts
+                if counts.sum() == 0:
+                    continue
+
+                # expand every agent into one row per agent in the neighbor cell
+                i = np.repeat(agents[valid], counts)
+                first_row = np.cumsum(counts) - counts
+                within_cell = np.arange(counts.sum()) - np.repeat(first_row, counts)
+                j = self.order[np.repeat(starts, counts) + within_cell]
+                i_parts.append(i)
+                j_parts.append(j)
+
+        if not i_parts:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, np.zeros(0)
+
+        i = np.concatenate(i_parts)
+        j = np.concatenate(j_parts)
+        differences = self.positions[j] - self.positions[i]
+        distances = np.hypot(differences[:, 0], differences[:, 1])
+        keep = (i != j) & (distances <= radius)
+        return i[keep], j[keep], distances[keep]
+
+
+# separation, alignment, cohesion and border avoidance of bidirectional.nlogo over arrays of all agents
+# unlike NetLogo, which asks the spheros one after another, all agents turn based on the headings at the
+# start of the step, so the result does not depend on the agent order
+class FlockingEngine(object):
+    def __init__(self, number_of_spheros, parameters=None, seed=None):
+        self.number_of_spheros = number_of_spheros
+        self.parameters = parameters if parameters is not None else FlockingParameters()
+        self.random = np.random.RandomState(seed)
+
+        # what the control loop consumes, like the lines NetLogo's send-commands writes
+        self.target_headings = np.zeros(number_of_spheros)
+        self.target_speeds = np.full(number_of_spheros, self.parameters.start_percent_speed)
+
+        self.separating = np.zeros(number_of_spheros, dtype=bool)  # NetLogo shows these as "x"
+
+    # returns the flockmates of every agent as (i, j, distance): other agents within visibility in its cone
+    def flockmates(self, positions, headings):
+        i, j, distances = SpatialGrid(positions, self.parameters.visibility).pairs_within(self.parameters.visibility)
+        if self.parameters.visibility_cone < 360:
+            differences = positions[j] - positions[i]
+            towards = netlogo_atan(differences[:, 0], differences[:, 1])
+            in_cone = (np.abs(subtract_headings(towards, headings[i])) <= self.parameters.visibility_cone / 2.0) | \
+                (distances == 0)
+            i, j, distances = i[in_cone], j[in_cone], distances[in_cone]
+        return i, j, distances
+
+    # computes the new headings of all agents and writes them to target_headings
+    def step(self, positions, headings):
+        positions = np.asarray(positions, dtype=float)
+        headings = np.asarray(headings, dtype=float)
+        parameters = self.parameters
+        new_headings = headings.copy()
+
+        # agents near the border only turn towards the center
+        patches = np.floor(positions + 0.5)
+        avoid_distance = min(parameters.visibility, parameters.border_avoidance_distance)
+        near_border = (patches[:, 0] < parameters.min_pxcor + 1 + avoid_distance) | \
+                      (patches[:, 1] < parameters.min_pycor + 1 + avoid_distance) | \
+                      (patches[:, 0] > parameters.max_pxcor - 1 - avoid_distance) | \
+                      (patches[:, 1] > parameters.max_pycor - 1 - avoid_distance)
+        if np.any(near_border):
+            towards_center = netlogo_atan(-positions[near_border, 0], -positions[near_border, 1])
+            new_headings[near_border] = turn_at_most(
+                headings[near_border], subtract_headings(towards_center, headings[near_border]),
+                parameters.max_center_turn)
+
+        i, j, distances = self.flockmates(positions, headings)
+        flocking = ~near_border[i]
+        i, j, distances = i[flocking], j[flocking], distances[flocking]
+
+        number_of_flockmates = np.bincount(i, minlength=self.number_of_spheros)
+        has_flockmates = (number_of_flockmates > 0) & ~near_border
+
+        # nearest flockmate: the first pair of every agent after sorting by agent, then distance
+        order = np.lexsort((distances, i))
+        agents, first = np.unique(i[order], return_index=True)
+        nearest = np.full(self.number_of_spheros, -1)
+        nearest_distance = np.full(self.number_of_spheros, np.inf)
+        nearest[agents] = j[order][first]
+        nearest_distance[agents] = distances[order][first]
+
+        self.separating = has_flockmates & (nearest_distance < parameters.min_separation)
+        self._separate(headings, new_headings, nearest, nearest_distance)
+
+        # align, then cohere with the aligned heading
+        cohering = has_flockmates & ~self.separating
+        radians = np.radians(headings[j])
+        sum_dx = np.bincount(i, np.sin(radians), self.number_of_spheros)
+        sum_dy = np.bincount(i, np.cos(radians), self.number_of_spheros)
+        aligned = self._turn_towards_mean(headings, sum_dx, sum_dy, parameters.max_align_turn)
+
+        differences = positions[j] - positions[i]
+        safe_distances = np.where(distances > 0, distances, 1.0)
+        mean_x = np.bincount(i, np.where(distances > 0, differences[:, 0] / safe_distances, 0), self.number_of_spheros)
+        mean_y = np.bincount(i, np.where(distances > 0, differences[:, 1] / safe_distances, 0), self.number_of_spheros)
+        cohered = self._turn_towards_mean(aligned, mean_x, mean_y, parameters.max_cohere_turn)
+        new_headings[cohering] = cohered[cohering]
+
+        # without flockmates the agents wiggle
+        alone = ~near_border & ~has_flockmates
+        wiggle = self.random.uniform(0, parameters.wiggle_degrees, (2, self.number_of_spheros))
+        new_headings[alone] = np.mod(headings[alone] + wiggle[0, alone] - wiggle[1, alone], 360.0)
+
+        self.target_headings[:] = new_headings.round(2)
+        return self.target_headings
+
+    def _separate(self, headings, new_headings, nearest, nearest_distance):
+        separating = self.separating
+        if not np.any(separating):
+            return
+        parameters = self.parameters
+        distance = nearest_distance[separating]
+
+        # full turn when very close, otherwise inversely related to the distance
+        k = -1.0 * parameters.max_separate_turn / (parameters.min_separation - 2.5)
+        d = parameters.max_separate_turn / (1 - 2.5 / parameters.min_separation)
+        turn_values = np.where(distance < 2.5, parameters.max_separate_turn, k * distance + d)
+
+        away = subtract_headings(headings[separating], headings[nearest[separating]])
+        new_headings[separating] = turn_at_most(headings[separating], away, np.abs(turn_values))
+
+    @staticmethod
+    def _turn_towards_mean(headings, x_components, y_components, max_turn):
+        target = np.where((x_components == 0) & (y_components == 0), headings,
+                          netlogo_atan(x_components, y_components))
+        return turn_at_most(headings, subtract_headings(target, headings), max_turn)
+
+    # NetLogo's NNI: mean nearest neighbor distance over the one expected for a random pattern
+    def nearest_neighbor_index(self, positions):
+        positions = np.asarray(positions, dtype=float)
+        if self.number_of_spheros < 2:
+            return float("nan")
+        parameters = self.parameters
+        cell_size = parameters.visibility
+        i, j, distances = SpatialGrid(positions, cell_size).pairs_within(2 * cell_size)
+
+        nearest_distance = np.full(self.number_of_spheros, np.inf)
+        np.minimum.at(nearest_distance, i, distances)
+
+        # a neighbor farther than one cell may still have a closer one outside the 3 x 3 cells, check those directly
+        for agent in np.flatnonzero(nearest_distance > cell_size):
+            others = np.delete(positions, agent, axis=0) - positions[agent]
+            nearest_distance[agent] = np.hypot(others[:, 0], others[:, 1]).min()
+
+        area = (parameters.max_pxcor - parameters.min_pxcor + 1 - 2) * \
+               (parameters.max_pycor - parameters.min_pycor + 1 - 2)
+        theoretical_mean = 0.5 / np.sqrt(self.number_of_spheros / float(area))
+        return nearest_distance.mean() / theoretical_mean
+
+    # the command lines NetLogo's send-commands procedure would write for the current targets
+    def command_lines(self):
+        return ["sphero_target_headings = [" + ", ".join("{0:.2f}".format(h) for h in self.target_headings) + "]",
+                "sphero_target_speeds = [" + ", ".join("{0:g}".format(s) for s in self.target_speeds) + "]"]
+
+
+# plays the NetLogo model over the socket transport: flocking on odometry fed back by bidirectional.py
+def run_stand_in_model(address, number_of_spheros, ticks, scale=5.0):
+    import ipc_bridge
+    from feedback_writer import parse_feedback_lines
+
+    engine = FlockingEngine(number_of_spheros)
+    client = ipc_bridge.NetLogoBridgeClient(address)
+    if not client.send_config(ipc_bridge.stand_in_config_lines(number_of_spheros, scale)):
+        raise ipc_bridge.BridgeException("config was rejected, does the number of Spheros match the Python script?")
+
+    positions = np.zeros((number_of_spheros, 2))
+    headings = np.zeros(number_of_spheros)
+    for _ in range(ticks):
+        # either feedback format, values missing from it are NaN and keep their last value
+        feedback = parse_feedback_lines(client.request_feedback(), number_of_spheros)
+        np.copyto(positions, feedback[:, :2], where=~np.isnan(feedback[:, :2]))
+        np.copyto(headings, feedback[:, 2], where=~np.isnan(feedback[:, 2]))
+        engine.step(positions, headings)
+        client.send_commands(engine.command_lines())
+    client.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Vectorized flocking of bidirectional.nlogo.")
+    parser.add_argument("--spheros", type=int, default=1000)
+    parser.add_argument("--ticks", type=int, default=100)
+    parser.add_argument("--address", default=None,
+                        help="drive bidirectional.py over its socket transport instead of benchmarking")
+    arguments = parser.parse_args()
+
+    if arguments.address is not None:
+        run_stand_in_model(arguments.address, arguments.spheros, arguments.ticks)
+    else:
+        side = np.sqrt(arguments.spheros) * 3.0  # ~9 patches per agent
+        world = int(side / 2) + 1
+        flocking_engine = FlockingEngine(arguments.spheros, FlockingParameters(
+            min_pxcor=-world, max_pxcor=world, min_pycor=-world, max_pycor=world), seed=1)
+        agent_positions = np.random.RandomState(2).uniform(-side / 2, side / 2, (arguments.spheros, 2))
+        agent_headings = np.random.RandomState(3).uniform(0, 360, arguments.spheros)
+        start = time.time()
+        for _ in range(arguments.ticks):
+            agent_headings = flocking_engine.step(agent_positions, agent_headings).copy()
+            radians = np.radians(agent_headings)
+            agent_positions += 0.5 * np.column_stack([np.sin(radians), np.cos(radians)])
+        print "{0} agents: {1:.3f} ms per flocking step, NNI {2:.3f}".format(
+            arguments.spheros, 1000 * (time.time() - start) / arguments.ticks,
+            flocking_engine.nearest_neighbor_index(agent_positions))
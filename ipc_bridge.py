@@ -0,0 +1,222 @@
+#!/usr/bin/python
+
+import argparse
+import os
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+
+from feedback_writer import FeedbackWriter
+
+# message kinds, every request is answered with exactly one reply
+CONFIG = "CONFIG"  # config.txt lines => OK or ERROR
+COMMANDS = "COMMANDS"  # commandsToRobots.txt lines => OK once the rolls were dispatched
+FEEDBACK = "FEEDBACK"  # no lines => FEEDBACK with the proceed.txt lines
+STOP = "STOP"  # model run stopped => OK
+OK = "OK"
+ERROR = "ERROR"
+
+# every frame is a 4 byte big-endian payload length followed by the payload:
+# the message kind, a newline and the message lines separated by newlines
+FRAME_HEADER = struct.Struct("!I")
+
+
+class BridgeException(Exception):
+    pass
+
+
+# "host:port" is a localhost TCP address, everything else a Unix domain socket path
+def parse_address(address):
+    host, separator, port = address.rpartition(":")
+    if separator and port.isdigit():
+        return socket.AF_INET, (host or "127.0.0.1", int(port))
+    return socket.AF_UNIX, address
+
+
+def send_message(connection, kind, lines=()):
+    payload = "\n".join([kind] + list(lines)).encode("utf-8")
+    connection.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+
+
+# returns (kind, lines), or (None, []) if the other side closed the connection
+def receive_message(connection):
+    header = _receive_exactly(connection, FRAME_HEADER.size)
+    if header is None:
+        return None, []
+    payload = _receive_exactly(connection, FRAME_HEADER.unpack(header)[0])
+    if payload is None:
+        raise BridgeException("connection closed in the middle of a message")
+    lines = payload.decode("utf-8").split("\n")
+    return lines[0], lines[1:]
+
+
+def _receive_exactly(connection, size):
+    chunks = []
+    while size > 0:
+        chunk = connection.recv(size)
+        if not chunk:
+            if chunks:
+                raise BridgeException("connection closed in the middle of a message")
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def _configure(connection, family):
+    if family == socket.AF_INET:
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # frames are small, don't batch them
+
+
+# Python side of the socket transport: NetLogo (or a stand-in client) connects and sends requests
+# replaces the config.txt / commandsToRobots.txt / proceed.txt handshake when netlogo_transport = "socket"
+class NetLogoBridgeServer(object):
+    def __init__(self, address):
+        self.family, self.address = parse_address(address)
+        if self.family == socket.AF_UNIX and os.path.exists(self.address):
+            os.remove(self.address)  # left over from a previous run
+
+        self.listener = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family == socket.AF_INET:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(self.address)
+        self.listener.listen(1)
+        self.connection = None
+
+    # blocks until a client connected, replaces an earlier connection
+    def accept(self):
+        self.close_connection()
+        self.connection, _ = self.listener.accept()
+        _configure(self.connection, self.family)
+
+    def receive(self):
+        return receive_message(self.connection)
+
+    def reply(self, kind, lines=()):
+        send_message(self.connection, kind, lines)
+
+    def close_connection(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def close(self):
+        self.close_connection()
+        self.listener.close()
+        if self.family == socket.AF_UNIX and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+# NetLogo side of the socket transport, used by the stand-in client below
+class NetLogoBridgeClient(object):
+    def __init__(self, address, timeout=10.0):
+        self.family, self.address = parse_address(address)
+        self.connection = socket.socket(self.family, socket.SOCK_STREAM)
+        self.connection.settimeout(timeout)
+        self.connection.connect(self.address)
+        _configure(self.connection, self.family)
+
+    # sends one request and blocks until its reply arrived
+    def request(self, kind, lines=()):
+        send_message(self.connection, kind, lines)
+        reply_kind, reply_lines = receive_message(self.connection)
+        if reply_kind is None:
+            raise BridgeException("connection closed before the reply to " + kind)
+        return reply_kind, reply_lines
+
+    def send_config(self, lines):
+        return self.request(CONFIG, lines)[0] == OK
+
+    def send_commands(self, lines):
+        return self.request(COMMANDS, lines)[0] == OK
+
+    def request_feedback(self):
+        return self.request(FEEDBACK)[1]
+
+    def stop(self):
+        self.request(STOP)
+        self.connection.close()
+
+
+########################################################################################################################
+# Stand-in client and loopback server for round trip benchmarks without NetLogo
+########################################################################################################################
+
+# config lines as NetLogo's write-config-file procedure writes them
+def stand_in_config_lines(number_of_spheros, scale):
+    positions = ", ".join("[{0:.1f},{1:.1f}]".format(-0.5 - 2 * i, -0.5) for i in range(number_of_spheros))
+    return ["number_of_spheros_in_netlogo = " + str(number_of_spheros),
+            "scale = " + str(scale),
+            "first_netlogo_pos = [" + positions + "]"]
+
+
+# command lines as NetLogo's send-commands procedure writes them
+def stand_in_command_lines(headings, speeds):
+    return ["sphero_target_headings = [" + ", ".join("{0:.2f}".format(h) for h in headings) + "]",
+            "sphero_target_speeds = [" + ", ".join(str(s) for s in speeds) + "]"]
+
+
+# answers requests like the control loop would, without robots: OK for everything, zeros as feedback
+def serve_loopback(server, number_of_spheros):
+    zeros = np.zeros(number_of_spheros)
+    feedback = FeedbackWriter(number_of_spheros).lines(np.zeros((number_of_spheros, 2)), zeros, zeros)
+    server.accept()
+    while True:
+        kind, _ = server.receive()
+        if kind is None:
+            return
+        if kind == FEEDBACK:
+            server.reply(FEEDBACK, feedback)
+        else:
+            server.reply(OK)
+        if kind == STOP:
+            return
+
+
+# plays NetLogo's part of the protocol for a number of ticks and returns the round trip times in s
+def run_stand_in_client(address, number_of_spheros, ticks, scale=2.5):
+    client = NetLogoBridgeClient(address)
+    if not client.send_config(stand_in_config_lines(number_of_spheros, scale)):
+        raise BridgeException("config was rejected, does the number of Spheros match the Python script?")
+
+    round_trips = np.zeros(ticks)
+    headings = np.random.uniform(0, 360, number_of_spheros)
+    speeds = [20] * number_of_spheros
+    for tick in range(ticks):
+        start = time.time()
+        client.send_commands(stand_in_command_lines(headings, speeds))
+        client.request_feedback()
+        round_trips[tick] = time.time() - start
+        headings = (headings + np.random.uniform(-10, 10, number_of_spheros)) % 360
+
+    client.stop()
+    return round_trips
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Stand-in NetLogo client for the socket transport.")
+    parser.add_argument("--address", default="127.0.0.1:50007",
+                        help="host:port or Unix domain socket path of bidirectional.py")
+    parser.add_argument("--spheros", type=int, default=4)
+    parser.add_argument("--ticks", type=int, default=1000)
+    parser.add_argument("--loopback", action="store_true",
+                        help="also start a stand-in server in this process to measure the transport alone")
+    arguments = parser.parse_args()
+
+    if arguments.loopback:
+        loopback_server = NetLogoBridgeServer(arguments.address)
+        server_thread = threading.Thread(target=serve_loopback, args=[loopback_server, arguments.spheros])
+        server_thread.daemon = True
+        server_thread.start()
+
+    times = run_stand_in_client(arguments.address, arguments.spheros, arguments.ticks) * 1000
+    print "{0} ticks with {1} Spheros: round trip mean {2:.3f} ms, p50 {3:.3f} ms, p99 {4:.3f} ms, max {5:.3f} ms" \
+        .format(arguments.ticks, arguments.spheros, times.mean(), np.percentile(times, 50),
+                np.percentile(times, 99), times.max())
+
+    if arguments.loopback:
+        server_thread.join()
+        loopback_server.close()
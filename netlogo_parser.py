@@ -0,0 +1,129 @@
+import re
+import time
+
+import numpy as np
+
+# statements NetLogo writes to config.txt and commandsToRobots.txt, e.g.
+# number_of_spheros_in_netlogo = 4
+# scale = 2.5
+# first_netlogo_pos = [[-0.5,-0.5], [4.5,-9.2]]
+# sphero_array[0].set_rgb_led(55, 126, 184, 0, False)
+# sphero_target_headings = [12.5, 270.03]
+# sphero_target_speeds = [20, 21]
+ASSIGNMENT_PATTERN = re.compile(r"^\s*([a-z_]+)\s*=\s*(.+?)\s*$")
+RGB_LED_PATTERN = re.compile(r"^\s*sphero_array\[(\d+)\]\.set_rgb_led\(([^)]*)\)\s*$")
+
+
+# parses the NetLogo config and command lines into preallocated arrays without compiling them as Python code
+# malformed lines are counted and skipped instead of raising, just like the exec loop skipped them before
+# values that are not finite (nan, inf) and a scale that is not positive count as malformed
+class NetLogoParser(object):
+    def __init__(self, number_of_spheros):
+        self.number_of_spheros = number_of_spheros
+
+        # config file values, -9999 until the config file overrides them
+        self.number_of_spheros_in_netlogo = -9999
+        self.scale = -9999
+        self.first_netlogo_pos = np.zeros((number_of_spheros, 2))
+
+        # command file values, overwritten in place every tick so other code can keep references to them
+        self.target_headings = np.zeros(number_of_spheros)
+        self.target_speeds = np.zeros(number_of_spheros)
+
+        # (sphero number, r, g, b) tuples, to be executed and cleared by the caller
+        self.rgb_led_commands = []
+
+        self.lines_parsed = 0
+        self.lines_rejected = 0
+        self.parse_time = 0.0  # s, summed over all parsed lines
+
+        self._list_parsers = {
+            "sphero_target_headings": self._parse_vector_into(self.target_headings),
+            "sphero_target_speeds": self._parse_vector_into(self.target_speeds),
+            "first_netlogo_pos": self._parse_positions,
+        }
+
+    # parses one line, returns the name of the statement or None if the line was rejected
+    def parse_line(self, line):
+        start = time.time()
+        statement = self._parse(line)
+        self.parse_time += time.time() - start
+
+        if statement is None:
+            self.lines_rejected += 1
+        else:
+            self.lines_parsed += 1
+        return statement
+
+    def parse_lines(self, lines):
+        for line in lines:
+            self.parse_line(line)
+
+    def _parse(self, line):
+        match = ASSIGNMENT_PATTERN.match(line)
+        if match is not None:
+            name, value = match.groups()
+            try:
+                if name in self._list_parsers:
+                    if not self._list_parsers[name](value):
+                        return None
+                elif name == "number_of_spheros_in_netlogo":
+                    self.number_of_spheros_in_netlogo = int(value)
+                elif name == "scale":
+                    scale = float(value)
+                    if not (np.isfinite(scale) and scale > 0):
+                        return None  # the coordinate transform divides by it
+                    self.scale = scale
+                else:
+                    return None
+            except ValueError:
+                return None
+            return name
+
+        match = RGB_LED_PATTERN.match(line)
+        if match is not None:
+            sphero_number = int(match.group(1))
+            arguments = match.group(2).split(",")
+            if sphero_number >= self.number_of_spheros or len(arguments) < 3:
+                return None  # happens if more Spheros are set in NetLogo than in the Python script
+            try:
+                r, g, b = [int(round(float(argument))) for argument in arguments[:3]]
+            except (ValueError, OverflowError):  # also nan and inf
+                return None
+            self.rgb_led_commands.append((sphero_number, r, g, b))
+            return "set_rgb_led"
+
+        return None
+
+    # returns a parser writing a flat list like [1.5, 2, 3] into the given array
+    def _parse_vector_into(self, target):
+        def parse(value):
+            if not (value.startswith("[") and value.endswith("]")):
+                return False
+            items = value[1:-1].split(",")
+            if len(items) != self.number_of_spheros:
+                return False
+            values = np.array([float(item) for item in items])
+            if not np.all(np.isfinite(values)):
+                return False
+            target[:] = values
+            return True
+
+        return parse
+
+    # parses a nested list like [[1.5,2], [3,4.5]] into the first NetLogo positions
+    def _parse_positions(self, value):
+        if not (value.startswith("[[") and value.endswith("]]")):
+            return False
+        pairs = value[2:-2].split("]")
+        if len(pairs) != self.number_of_spheros:
+            return False
+        positions = []
+        for pair in pairs:
+            x, y = pair.lstrip(", [").split(",")
+            positions.append((float(x), float(y)))
+        positions = np.array(positions)
+        if not np.all(np.isfinite(positions)):
+            return False
+        self.first_netlogo_pos[:] = positions
+        return True
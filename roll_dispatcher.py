@@ -0,0 +1,158 @@
+import Queue
+import threading
+import time
+
+import numpy as np
+
+
+# returns the integer roll speeds (0-255) and headings (0-359) of the whole fleet for the NetLogo targets,
+# speeds in percent of the maximum speed, headings relative to the calibrated internal headings
+def roll_arguments(internal_headings, target_headings, target_speeds):
+    # speeds and headings are positive, so floor(x + 0.5) rounds like round() did per sphero
+    speed_ints = np.floor(np.multiply(target_speeds, 255) / 100 + 0.5).astype(int)
+    heading_ints = np.floor(np.add(internal_headings, target_headings) + 0.5).astype(int) % 360
+    return speed_ints, heading_ints
+
+
+# sends roll commands through one long-lived worker thread per Sphero instead of spawning threads every tick
+# every worker has a queue of size 1: a command that was not sent yet is replaced by a newer one (coalesced),
+# and a roll with the same speed and heading as the last one sent is skipped
+class RollDispatcher(object):
+    def __init__(self, spheros, deadline=0.1):
+        self.spheros = spheros
+        self.deadline = deadline  # s, default for how long wait() blocks
+
+        number_of_spheros = len(spheros)
+        self.queues = [Queue.Queue(maxsize=1) for _ in range(number_of_spheros)]
+        self.workers = []
+
+        # generation numbers: wait() is done once every worker has completed the last command submitted to it
+        self.condition = threading.Condition()
+        self.submitted = [0] * number_of_spheros
+        self.completed = [0] * number_of_spheros
+        self.last_sent = [None] * number_of_spheros
+        self.skipped = [False] * number_of_spheros  # dropped Spheros, submit_all() leaves them out
+
+        # per Sphero send latencies in s
+        self.last_send_latencies = np.zeros(number_of_spheros)
+        self.max_send_latencies = np.zeros(number_of_spheros)
+        self.summed_send_latencies = np.zeros(number_of_spheros)
+        self.send_counts = np.zeros(number_of_spheros, dtype=int)
+
+        self.unchanged = 0  # skipped because speed and heading did not change
+        self.coalesced = 0  # replaced by a newer command before they were sent
+        self.dropped = 0  # failed to send, e.g. because the Bluetooth link was lost
+        self.deadline_misses = 0
+        self.errors = 0  # unexpected driver exceptions, also counted as dropped
+        self.last_error = None
+
+    def start(self):
+        self.last_sent = [None] * len(self.spheros)  # the Spheros may have been rolled directly in between
+        for sphero_number in range(len(self.spheros)):
+            worker = threading.Thread(target=self._work, args=[sphero_number], name="roll-" + str(sphero_number))
+            worker.daemon = True  # a hanging Bluetooth write must not keep the script alive
+            worker.start()
+            self.workers.append(worker)
+
+    # stops all workers after their current send, pending commands are discarded
+    def stop(self):
+        for queue in self.queues:
+            self._replace(queue, None)
+        for worker in self.workers:
+            worker.join(self.deadline)
+        self.workers = []
+
+    # hands a roll command for one Sphero to its worker, does not block
+    def submit(self, sphero_number, speed, heading):
+        with self.condition:
+            self.submitted[sphero_number] += 1
+            generation = self.submitted[sphero_number]
+        if self._replace(self.queues[sphero_number], (generation, speed, heading)):
+            with self.condition:
+                self.coalesced += 1
+
+    # hands roll commands for the whole fleet to the workers in one call, does not block
+    def submit_all(self, speeds, headings):
+        for sphero_number in range(len(self.spheros)):
+            if not self.skipped[sphero_number]:
+                self.submit(sphero_number, speeds[sphero_number], headings[sphero_number])
+
+    # leaves the given Spheros out of all further submit_all() calls, e.g. dropped ones without a link
+    def skip(self, sphero_numbers):
+        for sphero_number in sphero_numbers:
+            self.skipped[sphero_number] = True
+
+    # blocks until all submitted commands were sent or the deadline (in s) ran out
+    # returns False if some Spheros are still busy, their commands are still sent later on
+    def wait(self, timeout=None):
+        end = time.time() + (self.deadline if timeout is None else timeout)
+        with self.condition:
+            while self.completed != self.submitted:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    self.deadline_misses += 1
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def summary(self):
+        lines = ["Roll commands: {0} sent, {1} unchanged, {2} coalesced, {3} dropped, {4} deadline misses"
+                 .format(int(self.send_counts.sum()), self.unchanged, self.coalesced, self.dropped,
+                         self.deadline_misses)]
+        if self.errors:
+            lines.append("{0} unexpected errors, last one: {1}".format(self.errors, self.last_error))
+        for sphero_number in range(len(self.spheros)):
+            count = max(self.send_counts[sphero_number], 1)
+            lines.append("Sphero {0}: mean send latency {1:.1f} ms, max {2:.1f} ms"
+                         .format(sphero_number + 1, 1000 * self.summed_send_latencies[sphero_number] / count,
+                                 1000 * self.max_send_latencies[sphero_number]))
+        return "\n".join(lines)
+
+    # puts the item into a queue of size 1, returns True if an unsent item had to be removed for it
+    @staticmethod
+    def _replace(queue, item):
+        replaced = False
+        try:
+            queue.get_nowait()
+            replaced = True
+        except Queue.Empty:
+            pass
+        queue.put(item)
+        return replaced
+
+    def _work(self, sphero_number):
+        queue = self.queues[sphero_number]
+        while True:
+            command = queue.get()
+            if command is None:
+                return
+            generation, speed, heading = command
+
+            if (speed, heading) == self.last_sent[sphero_number]:
+                with self.condition:
+                    self.unchanged += 1
+            else:
+                start = time.time()
+                try:
+                    self.spheros[sphero_number].roll(speed, heading, 1, False)
+                    self.last_sent[sphero_number] = (speed, heading)
+                    self._record_latency(sphero_number, time.time() - start)
+                except (AttributeError, IOError):
+                    with self.condition:
+                        self.dropped += 1
+                except Exception as e:  # any other driver error must not end the worker of this Sphero
+                    with self.condition:
+                        self.dropped += 1
+                        self.errors += 1
+                        self.last_error = "Sphero {0}: {1}".format(sphero_number + 1, repr(e))
+
+            with self.condition:
+                self.completed[sphero_number] = max(self.completed[sphero_number], generation)
+                self.condition.notify_all()
+
+    def _record_latency(self, sphero_number, latency):
+        self.last_send_latencies[sphero_number] = latency
+        self.summed_send_latencies[sphero_number] += latency
+        self.send_counts[sphero_number] += 1
+        if latency > self.max_send_latencies[sphero_number]:
+            self.max_send_latencies[sphero_number] = latency
@@ -0,0 +1,185 @@
+import os
+import threading
+import time
+
+import numpy as np
+
+FORMAT_VERSION = 3
+
+# record kinds and the meaning of their four values
+HEADER = 0  # first record of every file: format version, sensor sample period in s, extrapolation on/off, filter on/off
+SAMPLE = 1  # DATA_STRM packet: ODOM_X, ODOM_Y in cm, VELOCITY_X, VELOCITY_Y in mm/s
+ROLL = 2  # roll command handed to the dispatcher: speed 0-255, heading in degrees, -, -
+COLLISION = 3  # collision event: speed, -, -, -
+TICK = 4  # end of a pass of the control loop: tick number, number of command lines, -, - (sphero = -1)
+CONFIG = 5  # per Sphero after the config was processed: first NetLogo x, first NetLogo y, internal heading, scale
+ORIGIN = 6  # per Sphero once the first positions are known: first odometry x, first odometry y, -, -
+FEEDBACK = 7  # per Sphero as sent to NetLogo: NetLogo x, NetLogo y, measured heading, measured speed
+SNAPSHOT = 8  # sensor snapshot the next feedback is calculated from: -, -, -, - (sphero = -1)
+END = 9  # last record of a closed file: -, -, -, - (sphero = number of records before it)
+
+KIND_NAMES = ["header", "sample", "roll", "collision", "tick", "config", "origin", "feedback", "snapshot", "end"]
+
+# 29 bytes per record, the file is nothing but these records back to back
+RECORD_DTYPE = np.dtype([("time", "<f8"), ("kind", "u1"), ("sphero", "<i4"), ("values", "<f4", (4,))])
+
+
+# appends records of a run to a binary file through memory-mapped chunks
+# the file is grown one chunk at a time, so recording a sample is a single row assignment into the mapped chunk
+# recording is safe from the driver threads, the file is cut to the records written when it is closed
+# and ends with an END record, files of runs that crashed end with the zero-filled rest of their last chunk
+class RunRecorder(object):
+    def __init__(self, path, number_of_spheros, sample_period=0.0, extrapolate=False, filtered=False,
+                 chunk_size=65536):
+        self.path = path
+        self.chunk_size = chunk_size  # records per chunk
+
+        self.record_file = open(path, "w+b")
+        self.lock = threading.Lock()
+        self.chunk = None
+        self.chunk_start = 0  # record index of the first record in the chunk
+        self.used = 0  # records used in the current chunk
+        self.records = 0
+        self._map_chunk(0)
+
+        self.record(HEADER, number_of_spheros, FORMAT_VERSION, sample_period, float(extrapolate), float(filtered))
+
+    def _map_chunk(self, chunk_start):
+        if self.chunk is not None:
+            self.chunk.flush()
+        self.record_file.truncate((chunk_start + self.chunk_size) * RECORD_DTYPE.itemsize)
+        self.chunk = np.memmap(self.record_file, dtype=RECORD_DTYPE, mode="r+",
+                               offset=chunk_start * RECORD_DTYPE.itemsize, shape=(self.chunk_size,))
+        self.chunk_start = chunk_start
+        self.used = 0
+
+    # appends one record, e.g. record(SAMPLE, sphero_number, odom_x, odom_y, vel_x, vel_y, timestamp)
+    def record(self, kind, sphero_number, value_0=0.0, value_1=0.0, value_2=0.0, value_3=0.0, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            if self.chunk is None:
+                return  # closed, callbacks that arrive after the run are not recorded
+            if self.used == self.chunk_size:
+                self._map_chunk(self.chunk_start + self.chunk_size)
+            self.chunk[self.used] = (timestamp, kind, sphero_number, (value_0, value_1, value_2, value_3))
+            self.used += 1
+            self.records += 1
+
+    # appends one record per Sphero with the same time, values are columns of length N (missing ones are 0)
+    def record_fleet(self, kind, columns, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        number_of_spheros = len(columns[0])
+        with self.lock:
+            if self.chunk is None:
+                return
+            written = 0
+            while written < number_of_spheros:
+                if self.used == self.chunk_size:
+                    self._map_chunk(self.chunk_start + self.chunk_size)
+                count = min(number_of_spheros - written, self.chunk_size - self.used)
+                rows = self.chunk[self.used:self.used + count]
+                rows["time"] = timestamp
+                rows["kind"] = kind
+                rows["sphero"] = np.arange(written, written + count)
+                rows["values"] = 0
+                for column_number, column in enumerate(columns):
+                    rows["values"][:, column_number] = column[written:written + count]
+                self.used += count
+                self.records += count
+                written += count
+
+    # shorthands for what bidirectional.py records
+    def record_sample(self, sphero_number, odom_x, odom_y, vel_x, vel_y, timestamp):
+        self.record(SAMPLE, sphero_number, odom_x, odom_y, vel_x, vel_y, timestamp)
+
+    def record_collision(self, sphero_number, speed):
+        self.record(COLLISION, sphero_number, speed)
+
+    def record_rolls(self, speeds, headings):
+        self.record_fleet(ROLL, [speeds, headings])
+
+    def record_tick(self, tick, number_of_commands):
+        self.record(TICK, -1, tick, number_of_commands)
+
+    def record_config(self, first_netlogo_pos, internal_headings, scale):
+        self.record_fleet(CONFIG, [first_netlogo_pos[:, 0], first_netlogo_pos[:, 1], internal_headings,
+                                   np.full(len(internal_headings), float(scale))])
+
+    def record_origin(self, first_sphero_pos):
+        self.record_fleet(ORIGIN, [first_sphero_pos[:, 0], first_sphero_pos[:, 1]])
+
+    def record_snapshot(self, timestamp):
+        self.record(SNAPSHOT, -1, timestamp=timestamp)
+
+    def record_feedback(self, netlogo_pos, measured_headings, measured_speeds, timestamp):
+        self.record_fleet(FEEDBACK, [netlogo_pos[:, 0], netlogo_pos[:, 1], measured_headings, measured_speeds],
+                          timestamp)
+
+    def close(self):
+        with self.lock:
+            if self.chunk is None:
+                return
+            if self.used == self.chunk_size:
+                self._map_chunk(self.chunk_start + self.chunk_size)
+            self.chunk[self.used] = (time.time(), END, self.records, (0.0, 0.0, 0.0, 0.0))
+            self.records += 1
+            self.chunk.flush()
+            self.chunk = None  # the mapping has to be released before the file can be cut
+            self.record_file.truncate(self.records * RECORD_DTYPE.itemsize)
+            self.record_file.close()
+
+    def summary(self):
+        return "Recorded {0} records ({1:.1f} MB) to {2}".format(
+            self.records, self.records * RECORD_DTYPE.itemsize / 1e6, self.path)
+
+
+# a recorded run, mapped read-only, records holds everything from the header to the last record before END
+# a file without END record was not closed properly: it is cut after the last record that was written
+# and complete is False
+class RecordedRun(object):
+    def __init__(self, path):
+        if os.path.getsize(path) % RECORD_DTYPE.itemsize:
+            raise ValueError(path + " is not a run record")
+        records = np.memmap(path, dtype=RECORD_DTYPE, mode="r")
+        if len(records) == 0 or records[0]["kind"] != HEADER:
+            raise ValueError(path + " has no run record header")
+
+        self.complete = records[-1]["kind"] == END
+        if self.complete:
+            if records[-1]["sphero"] != len(records) - 1:
+                raise ValueError("{0} has {1} records, but its end record counts {2}".format(
+                    path, len(records) - 1, records[-1]["sphero"]))
+            self.records = records[:-1]
+        else:
+            written = np.flatnonzero(records["time"] != 0)  # every record has a time, the unused rest is zeros
+            self.records = records[:written[-1] + 1]
+
+        header = self.records[0]
+        if int(header["values"][0]) != FORMAT_VERSION:
+            raise ValueError(path + " was recorded with format version " + str(int(header["values"][0])))
+        self.number_of_spheros = int(header["sphero"])
+        self.sample_period = float(header["values"][1])
+        self.extrapolate = bool(header["values"][2])
+        self.filtered = bool(header["values"][3])
+
+    # all records of one kind
+    def select(self, kind):
+        return self.records[self.records["kind"] == kind]
+
+    # the last record of a per-Sphero kind as an (N,4) array, e.g. fleet_values(CONFIG)
+    def fleet_values(self, kind):
+        records = self.select(kind)[-self.number_of_spheros:]
+        if len(records) != self.number_of_spheros:
+            raise ValueError("the run record has no complete set of " + KIND_NAMES[kind] + " records")
+        values = np.zeros((self.number_of_spheros, 4))
+        values[records["sphero"]] = records["values"]
+        return values
+
+    def summary(self):
+        counts = np.bincount(self.records["kind"], minlength=len(KIND_NAMES))
+        duration = self.records["time"][-1] - self.records["time"][0]
+        return "{0} Spheros, {1:.1f} s, ".format(self.number_of_spheros, duration) + \
+            ", ".join("{0} {1}".format(counts[kind], name) for kind, name in enumerate(KIND_NAMES)
+                      if kind not in (HEADER, END))
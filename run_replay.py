@@ -0,0 +1,132 @@
+#!/usr/bin/python
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+import run_recorder
+from coordinate_transform import CoordinateTransform
+from feedback_writer import FeedbackWriter
+from sensor_filter import ConstantVelocityFilter
+from sensor_store import SensorStore
+from tick_profiler import LatencyHistogram, monotonic
+
+
+# drives the sensor store, the coordinate transform and the feedback calculation of bidirectional.py
+# from a recorded run: samples are written with their recorded timestamps and every recorded feedback is
+# recalculated at the position and time of its snapshot record, so the results do not depend on the replay speed
+class RunReplay(object):
+    def __init__(self, recorded_run, speed=1.0):
+        self.run = recorded_run
+        self.speed = speed  # 1 = real time, N = N times faster, 0 = as fast as possible
+
+        config = recorded_run.fleet_values(run_recorder.CONFIG)
+        origin = recorded_run.fleet_values(run_recorder.ORIGIN)
+        number_of_spheros = recorded_run.number_of_spheros
+
+        self.sensor_store = SensorStore(number_of_spheros, sample_period=recorded_run.sample_period or None)
+        # runs are recorded with the default filter settings of bidirectional.py
+        self.sensor_filter = ConstantVelocityFilter(number_of_spheros) if recorded_run.filtered else None
+        self.coordinate_transform = CoordinateTransform(config[:, 2], config[0, 3])
+        self.coordinate_transform.set_origin(config[:, :2], origin[:, :2])
+        self.feedback_writer = FeedbackWriter(number_of_spheros)
+
+        self.feedback_histogram = LatencyHistogram()
+        self.feedbacks = 0
+        self.max_position_error = 0.0  # NetLogo patches
+        self.max_heading_error = 0.0  # degrees
+        self.max_speed_error = 0.0  # cm/s
+
+    # the feedback values bidirectional.py would send at the given time, (N,4) like the FEEDBACK records
+    def feedback_values(self, now):
+        sensor_snapshot = self.sensor_store.snapshot(now=now, extrapolate=self.run.extrapolate,
+                                                     sensor_filter=self.sensor_filter)
+        # formatted like the feedback commands, so the replay times the whole feedback path
+        self.feedback_writer.lines(self.coordinate_transform.to_netlogo(sensor_snapshot.positions),
+                                   self.coordinate_transform.to_netlogo_headings(sensor_snapshot.headings),
+                                   sensor_snapshot.speeds)
+        return self.feedback_writer.values
+
+    def _compare(self, values, recorded):
+        differences = np.abs(values - recorded)
+        heading_differences = np.abs((values[:, 2] - recorded[:, 2] + 180) % 360 - 180)
+        self.max_position_error = max(self.max_position_error, differences[:, :2].max())
+        self.max_heading_error = max(self.max_heading_error, heading_differences.max())
+        self.max_speed_error = max(self.max_speed_error, differences[:, 3].max())
+
+    # replays all records, returns the wall time it took in s
+    def replay(self):
+        records = self.run.records
+        times = records["time"].tolist()
+        kinds = records["kind"].tolist()
+        spheros = records["sphero"].tolist()
+        values = records["values"].astype(float)
+        number_of_spheros = self.run.number_of_spheros
+
+        first_time = times[0]
+        wall_start = monotonic()
+        feedback = None
+        index = 1  # after the header
+        while index < len(kinds):
+            kind = kinds[index]
+            if kind == run_recorder.SAMPLE:
+                odom_x, odom_y, vel_x, vel_y = values[index]
+                self.sensor_store.write(spheros[index], odom_x, odom_y, vel_x, vel_y, times[index])
+            elif kind == run_recorder.SNAPSHOT:
+                if self.speed > 0:
+                    delay = (times[index] - first_time) / self.speed - (monotonic() - wall_start)
+                    if delay > 0:
+                        time.sleep(delay)
+                start = monotonic()
+                feedback = self.feedback_values(times[index])
+                self.feedback_histogram.record(monotonic() - start)
+            elif kind == run_recorder.FEEDBACK:
+                # one record per Sphero in a row, after the snapshot they were calculated from
+                if feedback is None:
+                    raise ValueError("feedback without snapshot record at record " + str(index))
+                if index + number_of_spheros > len(kinds):
+                    break  # cut off, the run was not closed properly
+                self._compare(feedback, values[index:index + number_of_spheros])
+                feedback = None
+                self.feedbacks += 1
+                index += number_of_spheros
+                continue
+            index += 1
+        return monotonic() - wall_start
+
+    def summary(self):
+        histogram = self.feedback_histogram
+        if histogram.count == 0:
+            return "The run record contains no feedback."
+        return "Replayed {0} feedbacks: mean {1:.3f} ms, p99 {2:.3f} ms, max {3:.3f} ms\n" \
+               "Largest differences to the recorded feedback: position {4:.3f}, heading {5:.3f}, speed {6:.3f}" \
+            .format(self.feedbacks, 1000 * histogram.total / histogram.count, 1000 * histogram.percentile(99),
+                    1000 * histogram.maximum, self.max_position_error, self.max_heading_error,
+                    self.max_speed_error)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replays a run recorded by bidirectional.py (run_record_path).")
+    parser.add_argument("record", help="run record file")
+    parser.add_argument("--speed", type=float, default=0.0,
+                        help="1 = real time, N = N times faster, 0 = as fast as possible (default)")
+    parser.add_argument("--tolerance", type=float, default=0.02,
+                        help="largest difference to the recorded feedback that still passes the check")
+    arguments = parser.parse_args()
+
+    recorded_run = run_recorder.RecordedRun(arguments.record)
+    print recorded_run.summary()
+    if not recorded_run.complete:
+        print "Warning: " + arguments.record + " was not closed properly, the end of the run may be missing."
+    run_replay = RunReplay(recorded_run, arguments.speed)
+    wall_time = run_replay.replay()
+    recorded_time = recorded_run.records["time"][-1] - recorded_run.records["time"][0]
+    print "Replay took {0:.3f} s ({1:.1f}x real time)".format(wall_time, recorded_time / max(wall_time, 1e-9))
+    print run_replay.summary()
+
+    if max(run_replay.max_position_error, run_replay.max_heading_error,
+           run_replay.max_speed_error) > arguments.tolerance:
+        print "Replayed feedback differs from the recording by more than {0}.".format(arguments.tolerance)
+        sys.exit(1)
@@ -0,0 +1,76 @@
+import numpy as np
+
+
+# constant-velocity Kalman filter for the odometry of the whole fleet
+# the state of every Sphero is position (cm) and velocity (cm/s) per axis, both are measured by DATA_STRM
+# x and y are filtered independently, but as they are measured at the same times with the same noise
+# they share one 2x2 covariance matrix per Sphero
+class ConstantVelocityFilter(object):
+    def __init__(self, number_of_spheros, position_noise=1.0, velocity_noise=3.0, acceleration_noise=50.0,
+                 max_extrapolation=0.2):
+        self.position_variance = position_noise ** 2  # cm^2, odometry is reported in whole cm
+        self.velocity_variance = velocity_noise ** 2  # (cm/s)^2
+        self.acceleration_variance = acceleration_noise ** 2  # (cm/s^2)^2, how quickly a Sphero changes speed
+        self.max_extrapolation = max_extrapolation  # s, how far positions are predicted past the newest sample
+
+        self.positions = np.zeros((number_of_spheros, 2))
+        self.velocities = np.zeros((number_of_spheros, 2))
+        self.covariances = np.zeros((number_of_spheros, 2, 2))
+        self.times = np.zeros(number_of_spheros)  # of the last update
+        self.initialized = np.zeros(number_of_spheros, dtype=bool)
+        self.updates = 0
+
+    # adds one measurement for each of the given Spheros, times in s, positions in cm, velocities in cm/s
+    def update(self, rows, times, positions, velocities):
+        new = ~self.initialized[rows]
+        if np.any(new):
+            new_rows = rows[new]
+            self.positions[new_rows] = positions[new]
+            self.velocities[new_rows] = velocities[new]
+            self.covariances[new_rows] = [[self.position_variance, 0], [0, self.velocity_variance]]
+            self.times[new_rows] = times[new]
+            self.initialized[new_rows] = True
+            rows, times, positions, velocities = rows[~new], times[~new], positions[~new], velocities[~new]
+            if len(rows) == 0:
+                return
+
+        # predict
+        dt = np.maximum(times - self.times[rows], 0)
+        predicted_positions = self.positions[rows] + self.velocities[rows] * dt[:, None]
+        p = self.covariances[rows]
+        p00 = p[:, 0, 0] + dt * (p[:, 0, 1] + p[:, 1, 0]) + dt * dt * p[:, 1, 1]
+        p01 = p[:, 0, 1] + dt * p[:, 1, 1]
+        p11 = p[:, 1, 1]
+        p00 += self.acceleration_variance * dt ** 3 / 3
+        p01 += self.acceleration_variance * dt ** 2 / 2
+        p11 += self.acceleration_variance * dt
+
+        # update with position and velocity measured, gain = P (P + R)^-1
+        s00 = p00 + self.position_variance
+        s11 = p11 + self.velocity_variance
+        determinant = s00 * s11 - p01 * p01
+        k00 = (p00 * s11 - p01 * p01) / determinant
+        k01 = (p01 * s00 - p00 * p01) / determinant
+        k10 = (p01 * s11 - p11 * p01) / determinant
+        k11 = (p11 * s00 - p01 * p01) / determinant
+
+        position_residuals = positions - predicted_positions
+        velocity_residuals = velocities - self.velocities[rows]
+        self.positions[rows] = predicted_positions + k00[:, None] * position_residuals + \
+            k01[:, None] * velocity_residuals
+        self.velocities[rows] += k10[:, None] * position_residuals + k11[:, None] * velocity_residuals
+
+        # P = (I - K) P
+        self.covariances[rows, 0, 0] = (1 - k00) * p00 - k01 * p01
+        self.covariances[rows, 0, 1] = (1 - k00) * p01 - k01 * p11
+        self.covariances[rows, 1, 0] = self.covariances[rows, 0, 1]
+        self.covariances[rows, 1, 1] = (1 - k11) * p11 - k10 * p01
+        self.times[rows] = times
+        self.updates += len(rows)
+
+    # filtered positions of all Spheros at time now, into out
+    def predict_positions(self, now, out):
+        extrapolation = np.clip(now - self.times, 0, self.max_extrapolation)
+        np.multiply(self.velocities, extrapolation[:, None], out=out)
+        out += self.positions
+        return out
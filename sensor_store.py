@@ -0,0 +1,134 @@
+import time
+
+import numpy as np
+
+from coordinate_transform import velocities_to_headings_and_speeds
+
+# columns of one stored sample
+TIMESTAMP = 0
+ODOM_X = 1
+ODOM_Y = 2
+VELOCITY_X = 3
+VELOCITY_Y = 4
+SAMPLE_FIELDS = 5
+
+
+# consistent fleet-wide view of the sensor data at one point in time
+# the arrays are reused by the next snapshot() call, copy them if they are needed for longer than a tick
+class SensorSnapshot(object):
+    def __init__(self, number_of_spheros):
+        self.timestamp = 0.0
+        self.positions = np.zeros((number_of_spheros, 2))  # odometry in cm
+        self.velocities = np.zeros((number_of_spheros, 2))  # mm/s
+        self.headings = np.zeros(number_of_spheros)  # degrees, from the velocity vector
+        self.speeds = np.zeros(number_of_spheros)  # cm/s
+        self.sample_timestamps = np.zeros(number_of_spheros)
+        self.ages = np.zeros(number_of_spheros)  # s since the newest sample, inf if there was none yet
+        self.sample_counts = np.zeros(number_of_spheros, dtype=np.int64)
+
+
+# keeps the last samples of every Sphero's DATA_STRM in a preallocated ring buffer
+# driver threads write without locks: the sample is stored first and only then published by raising the count,
+# snapshot() rereads the counts afterwards and retries if a writer lapped the buffer in between
+class SensorStore(object):
+    def __init__(self, number_of_spheros, capacity=8, sample_period=None, max_extrapolation=0.2):
+        if capacity < 4:
+            raise ValueError("the sensor ring buffer needs room for at least 4 samples per Sphero")
+        self.number_of_spheros = number_of_spheros
+        self.capacity = capacity
+        self.sample_period = sample_period  # s between packets, used to count dropped packets
+        self.max_extrapolation = max_extrapolation  # s, how far positions are predicted past the newest sample
+        self.gap_grace_end = 0.0  # s, gaps before samples received until then are not counted as dropped packets
+
+        self.samples = np.zeros((number_of_spheros, capacity, SAMPLE_FIELDS))
+        self.counts = np.zeros(number_of_spheros, dtype=np.int64)  # newest sample is at (count - 1) % capacity
+        self.dropped = np.zeros(number_of_spheros, dtype=np.int64)
+        self.filtered = np.zeros(number_of_spheros, dtype=np.int64)  # samples already handed to a sensor filter
+
+        self._rows = np.arange(number_of_spheros)
+        self._counts_after = np.zeros(number_of_spheros, dtype=np.int64)
+        self._snapshot = SensorSnapshot(number_of_spheros)
+
+    # stores one sample, called from the driver's callback thread of that Sphero
+    def write(self, sphero_number, odom_x, odom_y, vel_x, vel_y, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        count = self.counts[sphero_number]
+
+        if count > 0 and self.sample_period and timestamp > self.gap_grace_end:
+            gap = timestamp - self.samples[sphero_number, (count - 1) % self.capacity, TIMESTAMP]
+            missed = int(gap / self.sample_period + 0.5) - 1
+            if missed > 0:
+                self.dropped[sphero_number] += missed
+
+        slot = count % self.capacity
+        self.samples[sphero_number, slot, TIMESTAMP] = timestamp
+        self.samples[sphero_number, slot, ODOM_X] = odom_x
+        self.samples[sphero_number, slot, ODOM_Y] = odom_y
+        self.samples[sphero_number, slot, VELOCITY_X] = vel_x
+        self.samples[sphero_number, slot, VELOCITY_Y] = vel_y
+        self.counts[sphero_number] = count + 1  # publish
+
+    # returns the newest samples of all Spheros, optionally with positions extrapolated to the given time
+    # with a sensor filter (see sensor_filter.py), all samples since the last snapshot are fed to it first
+    # and the positions are the filter's estimates at the given time instead
+    def snapshot(self, now=None, extrapolate=False, sensor_filter=None):
+        if now is None:
+            now = time.time()
+        snapshot = self._snapshot
+
+        while True:
+            np.copyto(snapshot.sample_counts, self.counts)
+            newest = self.samples[self._rows, (snapshot.sample_counts - 1) % self.capacity]
+            unfiltered = self._unfiltered_samples(snapshot.sample_counts) if sensor_filter is not None else []
+            np.copyto(self._counts_after, self.counts)
+            # the samples read are intact as long as no writer got around the ring buffer meanwhile
+            margin = self.capacity // 2 if sensor_filter is not None else self.capacity - 2
+            if np.all(self._counts_after - snapshot.sample_counts < margin):
+                break
+
+        snapshot.timestamp = now
+        snapshot.sample_timestamps[:] = newest[:, TIMESTAMP]
+        snapshot.velocities[:] = newest[:, VELOCITY_X:VELOCITY_Y + 1]
+        velocities_to_headings_and_speeds(newest[:, VELOCITY_X], newest[:, VELOCITY_Y],
+                                          snapshot.headings, snapshot.speeds)
+
+        np.subtract(now, snapshot.sample_timestamps, out=snapshot.ages)
+        snapshot.ages[snapshot.sample_counts == 0] = np.inf
+
+        if sensor_filter is not None:
+            for rows, samples in unfiltered:
+                sensor_filter.update(rows, samples[:, TIMESTAMP], samples[:, ODOM_X:ODOM_Y + 1],
+                                     samples[:, VELOCITY_X:VELOCITY_Y + 1] / 10)
+            np.copyto(self.filtered, snapshot.sample_counts)
+            sensor_filter.predict_positions(now, snapshot.positions)
+            snapshot.positions[snapshot.sample_counts == 0] = 0
+        elif extrapolate:
+            self._extrapolate(snapshot, newest)
+        else:
+            snapshot.positions[:] = newest[:, ODOM_X:ODOM_Y + 1]
+        return snapshot
+
+    # the samples that arrived since the last filtered snapshot as (rows, samples) batches, oldest first
+    # at most half the ring buffer per Sphero, older ones may already be overwritten
+    def _unfiltered_samples(self, counts):
+        new = np.minimum(counts - self.filtered, self.capacity // 2)
+        batches = []
+        for age in range(int(new.max()) - 1, -1, -1):
+            rows = self._rows[new > age]
+            batches.append((rows, self.samples[rows, (counts[rows] - 1 - age) % self.capacity]))
+        return batches
+
+    # positions at snapshot.timestamp: the snapshot is taken after the newest sample, so the newest position is
+    # moved along its velocity (mm/s => / 10 => cm/s) for at most max_extrapolation seconds
+    def _extrapolate(self, snapshot, newest):
+        extrapolation = np.clip(snapshot.timestamp - newest[:, TIMESTAMP], 0, self.max_extrapolation)
+        np.multiply(newest[:, VELOCITY_X:VELOCITY_Y + 1], extrapolation[:, None] / 10, out=snapshot.positions)
+        snapshot.positions += newest[:, ODOM_X:ODOM_Y + 1]
+
+        # without any sample there is nothing to extrapolate from
+        snapshot.positions[snapshot.sample_counts == 0] = 0
+
+    def summary(self):
+        return "Sensor packets: {0} received, {1} estimated dropped, per Sphero {2}" \
+            .format(int(self.counts.sum()), int(self.dropped.sum()), self.counts.tolist())
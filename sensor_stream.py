@@ -0,0 +1,48 @@
+import threading
+import time
+
+import numpy as np
+
+
+# the DATA_STRM callback of all Spheros: stores the odometry samples, records them and wakes the main loop
+# headings and speeds are derived from the samples per tick, so a callback only writes the raw values
+# while recording, samples are stored and recorded under one lock, so the samples before a snapshot record
+# are exactly those the snapshot saw
+# the first sample after capture_first was set becomes the Sphero's first position, the origin of its odometry
+class SensorDataStream(object):
+    def __init__(self, sensor_store, control_events, run_recorder=None):
+        self.sensor_store = sensor_store
+        self.control_events = control_events
+        self.run_recorder = run_recorder
+        self.recording_lock = threading.Lock()
+
+        self.capture_first = False  # set once the config file was processed
+        self.first_pending = [True] * sensor_store.number_of_spheros
+        self.first_positions = np.zeros((sensor_store.number_of_spheros, 2))
+
+    # registered with partial(sensor_data_stream.callback, sphero_number=n) for every Sphero
+    def callback(self, callback, sphero_number):
+        odom_x = float(callback.get('ODOM_X'))
+        odom_y = float(callback.get('ODOM_Y'))
+
+        # velocities are sent in mm/s
+        vel_x = float(callback.get('VELOCITY_X'))
+        vel_y = float(callback.get('VELOCITY_Y'))
+
+        # shard workers pass the time they received the packet, the driver threads call back right on receipt
+        timestamp = callback.get('TIMESTAMP')
+        if timestamp is None:
+            timestamp = time.time()
+        if self.run_recorder is not None:
+            with self.recording_lock:
+                self.sensor_store.write(sphero_number, odom_x, odom_y, vel_x, vel_y, timestamp)
+                self.run_recorder.record_sample(sphero_number, odom_x, odom_y, vel_x, vel_y, timestamp)
+        else:
+            self.sensor_store.write(sphero_number, odom_x, odom_y, vel_x, vel_y, timestamp)
+
+        if self.first_pending[sphero_number] and self.capture_first:
+            self.first_positions[sphero_number, 0] = odom_x
+            self.first_positions[sphero_number, 1] = odom_y
+            self.first_pending[sphero_number] = False
+
+        self.control_events.notify_sample(sphero_number)
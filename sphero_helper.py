@@ -1,6 +1,9 @@
 import os
 
-from sphero_driver import sphero_driver
+try:
+    from sphero_driver import sphero_driver
+except ImportError:  # simulated Spheros use the same callback ids
+    import sphero_sim as sphero_driver
 
 
 class SpheroException(Exception):
@@ -19,7 +22,7 @@ def stop_spheros(spheros):
     for s in spheros:
         try:
             s.roll(0, 0, 1, False)
-        except AttributeError:
+        except (AttributeError, IOError):  # e.g. BluetoothError of a lost link
             continue
 
         for cb in {'PWR_NOTIFY', 'COLLISION', 'DATA_STRM'}:
@@ -0,0 +1,275 @@
+import random
+import threading
+import time
+
+import numpy as np
+
+# same message ids as sphero_driver, so callbacks can be registered the same way for both backends
+IDCODE = dict(
+    PWR_NOTIFY=chr(0x01),
+    LEVEL1_DIAG=chr(0x02),
+    DATA_STRM=chr(0x03),
+    CONFIG_BLOCK=chr(0x04),
+    SLEEP=chr(0x05),
+    MACRO_MARKERS=chr(0x06),
+    COLLISION=chr(0x07),
+)
+
+# power states as reported by PWR_NOTIFY
+BATTERY_CHARGING = 1
+BATTERY_OK = 2
+BATTERY_LOW = 3
+BATTERY_CRITICAL = 4
+
+MAX_SAMPLE_RATE = 400.0  # Hz, set_all_data_strm divides this by sample_div
+
+
+# returns fake Bluetooth addresses for a simulated fleet
+def simulated_addresses(number_of_spheros):
+    return ["SIM:{0:02X}:{1:02X}".format(i // 256, i % 256) for i in range(number_of_spheros)]
+
+
+# steps all simulated Spheros in one thread with vectorized kinematics and emits their async callbacks
+# every robot starts on a grid cell inside a square arena, its odometry starts at (0, 0) like on a real Sphero
+class SimulatedWorld(object):
+    def __init__(self, arena_size=250.0, max_speed=200.0, acceleration_time=0.3, heading_noise=2.0,
+                 link_latency=0.005, link_jitter=0.002, connect_time=0.05, connect_failure_rate=0.0,
+                 battery_life=3600.0, time_step=0.01, seed=None):
+        self.arena_size = arena_size  # cm, collisions are detected at its borders
+        self.max_speed = max_speed  # cm/s at roll speed 255
+        self.acceleration_time = acceleration_time  # s, time constant of the speed controller
+        self.heading_noise = heading_noise  # degrees standard deviation of the heading drift after 1 s of driving
+        self.link_latency = link_latency  # s every command blocks, like a Bluetooth write
+        self.link_jitter = link_jitter
+        self.connect_time = connect_time
+        self.connect_failure_rate = connect_failure_rate
+        self.battery_life = battery_life  # s until the battery is empty
+        self.time_step = time_step
+
+        self.random = random.Random(seed)
+        self.noise = np.random.RandomState(seed)
+
+        self.spheros = []
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+
+        self.start_pos = np.zeros((0, 2))
+        self.odometry = np.zeros((0, 2))  # cm
+        self.velocity = np.zeros((0, 2))  # cm/s
+        self.heading = np.zeros(0)  # actual driving direction in degrees, clockwise from +y
+        self.target_speed = np.zeros(0)  # cm/s
+        self.target_heading = np.zeros(0)
+        self.heading_drift = np.zeros(0)  # degrees, random walk between the commanded and the actual heading
+        self.battery = np.zeros(0)  # 1 = full
+
+    def register(self, sphero):
+        with self.lock:
+            index = len(self.spheros)
+            self.spheros.append(sphero)
+            self.start_pos = np.vstack([self.start_pos, self._grid_position(index)])
+            self.odometry = np.vstack([self.odometry, [0.0, 0.0]])
+            self.velocity = np.vstack([self.velocity, [0.0, 0.0]])
+            self.heading = np.append(self.heading, 0.0)
+            self.target_speed = np.append(self.target_speed, 0.0)
+            self.target_heading = np.append(self.target_heading, 0.0)
+            self.heading_drift = np.append(self.heading_drift, 0.0)
+            self.battery = np.append(self.battery, 1.0)
+        return index
+
+    # cells 30 cm apart around the arena center, in rows as long as the square root of the fleet size
+    def _grid_position(self, index):
+        per_row = max(int(np.ceil(np.sqrt(index + 1))), 1)
+        return [(index % per_row) * 30.0 - self.arena_size / 4, (index // per_row) * 30.0 - self.arena_size / 4]
+
+    # blocks for the simulated link latency of one command
+    def transmit(self):
+        delay = self.link_latency + self.random.uniform(-self.link_jitter, self.link_jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+            self.thread = threading.Thread(target=self._run, name="sphero-sim")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def _run(self):
+        last = time.time()
+        while self.running:
+            time.sleep(self.time_step)
+            now = time.time()
+            self.step(now - last, now)
+            last = now
+
+    # advances all robots by dt seconds and emits the callbacks that are due at time now
+    def step(self, dt, now):
+        with self.lock:
+            moving = self.target_speed > 0
+
+            # the heading drifts off the commanded one only while driving (a random walk, so the error builds up
+            # like the odometry error of a real Sphero), the speed follows the target with a first order lag
+            step_noise = self.noise.normal(0.0, self.heading_noise * np.sqrt(dt), len(self.heading))
+            self.heading_drift += np.where(moving, step_noise, 0.0)
+            self.heading = np.where(moving, self.target_heading + self.heading_drift, self.heading) % 360
+            speed = np.hypot(self.velocity[:, 0], self.velocity[:, 1])
+            speed += (self.target_speed - speed) * min(dt / self.acceleration_time, 1.0)
+
+            radians = np.radians(self.heading)
+            self.velocity[:, 0] = speed * np.sin(radians)
+            self.velocity[:, 1] = speed * np.cos(radians)
+            self.odometry += self.velocity * dt
+            self.battery -= dt / self.battery_life
+
+            # stop at the arena borders and report a collision
+            world_pos = self.start_pos + self.odometry
+            limit = self.arena_size / 2
+            outside = np.any(np.abs(world_pos) > limit, axis=1)
+            if np.any(outside):
+                self.odometry[outside] = np.clip(world_pos[outside], -limit, limit) - self.start_pos[outside]
+                self.velocity[outside] = 0
+
+            odometry = self.odometry.copy()
+            velocity = self.velocity.copy()
+            battery = self.battery.copy()
+            spheros = list(self.spheros)
+
+        for index, sphero in enumerate(spheros):
+            if outside[index]:
+                sphero.emit_collision(speed[index], now)
+            sphero.emit_power_state(battery[index])
+            sphero.emit_data_stream(odometry[index], velocity[index], now)
+
+
+# stand-in for sphero_driver.Sphero with the methods bidirectional.py and sphero_helper use
+class Sphero(object):
+    def __init__(self, target_name="Sphero", target_addr=None, world=None):
+        self.target_name = target_name
+        self.target_addr = target_addr
+        self.world = world if world is not None else default_world()
+        self.index = self.world.register(self)
+
+        self.is_connected = False
+        self.stabilization = True
+        self.rgb = (0, 0, 0)
+        self.back_led = 0
+
+        self.callbacks = {}
+        self.power_notify = False
+        self.power_state = BATTERY_OK
+        self.collision_detection = False
+        self.collision_dead_time = 0.0  # s after a collision before the next one is reported
+        self.next_collision_time = 0.0
+        self.stream_period = None  # s between DATA_STRM packets, None = stream off
+        self.next_stream_time = 0.0
+
+    def connect(self):
+        time.sleep(self.world.connect_time)
+        self.is_connected = self.world.random.random() >= self.world.connect_failure_rate
+        return self.is_connected
+
+    def disconnect(self):
+        self.is_connected = False
+        self.stream_period = None
+        with self.world.lock:
+            self.world.target_speed[self.index] = 0
+        if not any(sphero.is_connected for sphero in self.world.spheros):
+            self.world.stop()  # nothing left to simulate
+        return True
+
+    def start(self):
+        self.world.start()
+
+    def _send(self):
+        if not self.is_connected:
+            raise AttributeError("simulated Sphero " + str(self.target_addr) + " is not connected")
+        self.world.transmit()
+
+    def roll(self, speed, heading, state, response):
+        self._send()
+        with self.world.lock:
+            self.world.target_speed[self.index] = speed / 255.0 * self.world.max_speed if state else 0
+            self.world.target_heading[self.index] = heading
+
+    def set_rgb_led(self, red, green, blue, save, response):
+        self._send()
+        self.rgb = (red, green, blue)
+
+    def set_back_led(self, brightness, response):
+        self._send()
+        self.back_led = brightness
+
+    # the misspelling is part of the sphero_driver API
+    def set_stablization(self, enable, response):
+        self._send()
+        self.stabilization = bool(enable)
+
+    def set_power_notify(self, enable, response):
+        self._send()
+        self.power_notify = bool(enable)
+
+    def config_collision_detect(self, method, xt, xspd, yt, yspd, dead, response):
+        self._send()
+        self.collision_detection = method != 0
+        self.collision_dead_time = dead / 100.0  # like the firmware, in 10 ms units
+
+    def set_all_data_strm(self, sample_div, sample_frames, pcnt, response):
+        self._send()
+        self.stream_period = sample_div * sample_frames / MAX_SAMPLE_RATE
+
+    def go_to_sleep(self, time_value, macro, response):
+        self.disconnect()
+
+    def add_async_callback(self, callback_type, callback):
+        self.callbacks[callback_type] = callback
+
+    def remove_async_callback(self, callback_type):
+        del self.callbacks[callback_type]
+
+    def emit_data_stream(self, odometry, velocity, now):
+        callback = self.callbacks.get(IDCODE['DATA_STRM'])
+        if callback is None or self.stream_period is None or now < self.next_stream_time:
+            return
+        self.next_stream_time = max(self.next_stream_time + self.stream_period, now)
+        # odometry in cm, velocities in mm/s, like the real data stream
+        callback({'ODOM_X': odometry[0], 'ODOM_Y': odometry[1],
+                  'VELOCITY_X': velocity[0] * 10, 'VELOCITY_Y': velocity[1] * 10})
+
+    def emit_collision(self, speed, now):
+        callback = self.callbacks.get(IDCODE['COLLISION'])
+        if callback is None or not self.collision_detection or now < self.next_collision_time:
+            return
+        self.next_collision_time = now + self.collision_dead_time
+        callback({'Speed': int(speed), 'Timestamp': now})
+
+    def emit_power_state(self, battery):
+        if battery < 0.05:
+            state = BATTERY_CRITICAL
+        elif battery < 0.2:
+            state = BATTERY_LOW
+        else:
+            state = BATTERY_OK
+        if state == self.power_state:
+            return
+        self.power_state = state
+        callback = self.callbacks.get(IDCODE['PWR_NOTIFY'])
+        if callback is not None and self.power_notify:
+            callback(state)
+
+
+_default_world = []
+
+
+def default_world():
+    if not _default_world:
+        _default_world.append(SimulatedWorld())
+    return _default_world[0]
@@ -0,0 +1,118 @@
+import math
+import threading
+import time
+
+MAX_SAMPLE_RATE = 400.0  # Hz, set_all_data_strm divides this by the sample divisor
+
+# size of a DATA_STRM packet with set_all_data_strm: every frame holds all streamed sensor values
+# (about 30 values of 2 bytes), a packet adds start bytes, id code, length and checksum
+FRAME_BYTES = 60
+PACKET_OVERHEAD = 6
+
+
+# chooses the data stream sample divisor and frames per packet for the fleet
+# the first choice is made from the fleet size, the expected tick period and the Bluetooth budget,
+# during the run it follows the measured tick period and backs off when packets get lost or sending gets slow
+class StreamRateController(object):
+    def __init__(self, number_of_spheros, link_budget=5000.0, tick_period=0.1, samples_per_tick=2.0,
+                 min_divisor=20, max_divisor=200, max_frames=1, max_loss=0.05, max_send_latency=0.05,
+                 evaluation_interval=2.0):
+        self.number_of_spheros = number_of_spheros
+        self.link_budget = link_budget  # bytes/s all data streams together may use
+        self.samples_per_tick = samples_per_tick  # wanted samples per Sphero between two NetLogo ticks
+        self.min_divisor = min_divisor
+        self.max_divisor = max_divisor
+        self.max_frames = max_frames
+        self.max_loss = max_loss  # share of packets that may get lost before backing off
+        self.max_send_latency = max_send_latency  # s per roll command before backing off
+        self.evaluation_interval = evaluation_interval  # s between adjustments
+
+        self.tick_period = tick_period  # s, measured during the run
+        self.backoff = 1.0  # > 1: fewer samples than the budget allows, < 1: more, because the link copes
+        self.divisor, self.frames = self.choose(tick_period)
+        self.changes = 0
+        self.applying = None
+
+        self.window_start = None
+        self.window_values = None
+        self.command_ticks = 0
+
+    # sample period between two samples of one Sphero in s
+    @property
+    def sample_period(self):
+        return self.divisor / MAX_SAMPLE_RATE
+
+    # returns (divisor, frames) for a tick period in s
+    def choose(self, tick_period):
+        wanted_rate = self.samples_per_tick / tick_period
+
+        # bundling frames saves packet overhead, but a packet should still arrive twice per tick
+        frames = int(min(max(tick_period / 2 * wanted_rate, 1), self.max_frames))
+        bytes_per_sample = FRAME_BYTES + PACKET_OVERHEAD / float(frames)
+        budget_rate = self.link_budget / (self.number_of_spheros * bytes_per_sample)
+
+        rate = min(wanted_rate, budget_rate / self.backoff)
+        divisor = int(math.ceil(MAX_SAMPLE_RATE / rate))
+        return min(max(divisor, self.min_divisor), self.max_divisor), frames
+
+    # called once per pass of the main loop with counters since the start of the run
+    # returns True if the divisor or frames changed and apply() should be called
+    def update(self, now, new_commands, packets_received, packets_dropped, summed_send_latency, sends):
+        values = (packets_received, packets_dropped, summed_send_latency, sends)
+        if self.window_start is None:
+            self.window_start, self.window_values = now, values
+            return False
+        if new_commands:
+            self.command_ticks += 1
+        if now - self.window_start < self.evaluation_interval:
+            return False
+
+        received, dropped, send_latency, send_count = [v - w for v, w in zip(values, self.window_values)]
+        if self.command_ticks:
+            self.tick_period = (now - self.window_start) / self.command_ticks
+        loss = dropped / float(received + dropped) if received + dropped else 0.0
+        mean_send_latency = send_latency / send_count if send_count else 0.0
+        self.window_start, self.window_values = now, values
+        self.command_ticks = 0
+
+        if loss > self.max_loss or mean_send_latency > self.max_send_latency:
+            self.backoff = min(self.backoff * 1.5, 8.0)
+        else:
+            self.backoff = max(self.backoff / 1.1, 0.5)
+
+        divisor, frames = self.choose(self.tick_period)
+        # small changes are not worth a command to every Sphero
+        if frames == self.frames and abs(divisor - self.divisor) < 0.1 * self.divisor:
+            return False
+        if self.applying is not None and self.applying.is_alive():
+            return False
+        self.divisor, self.frames = divisor, frames
+        self.changes += 1
+        return True
+
+    # sends the current divisor and frames to all Spheros in a background thread
+    # the sample period of the sensor store is only switched once every Sphero got the command, until then and
+    # while packets sent at the old rate may still arrive, the gaps between samples are not counted as drops
+    def apply(self, spheros, sensor_store=None):
+        self.applying = threading.Thread(target=self._apply, args=[spheros, self.divisor, self.frames, sensor_store])
+        self.applying.daemon = True
+        self.applying.start()
+
+    @staticmethod
+    def _apply(spheros, divisor, frames, sensor_store):
+        if sensor_store is not None:
+            sensor_store.gap_grace_end = float("inf")  # the Spheros switch one after the other
+        for sphero in spheros:
+            try:
+                sphero.set_all_data_strm(divisor, frames, 0, False)
+            except (AttributeError, IOError):
+                continue  # lost link, the Sphero keeps streaming at its old rate
+        if sensor_store is not None:
+            old_period = sensor_store.sample_period or 0.0
+            sensor_store.sample_period = divisor / MAX_SAMPLE_RATE
+            sensor_store.gap_grace_end = time.time() + 2 * max(old_period, sensor_store.sample_period)
+
+    def summary(self):
+        return "Data stream: sample divisor {0} ({1:.1f} Hz per Sphero), {2} frames per packet, " \
+               "{3} changes, tick period {4:.3f} s".format(self.divisor, MAX_SAMPLE_RATE / self.divisor,
+                                                            self.frames, self.changes, self.tick_period)
@@ -0,0 +1,177 @@
+import csv
+import ctypes
+import ctypes.util
+import json
+import math
+import os
+import threading
+import time
+
+import numpy as np
+
+CLOCK_MONOTONIC = 1
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+# returns a monotonic clock function in s: time.monotonic if there is one, else clock_gettime, else time.time
+def _monotonic_clock():
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+    library_name = ctypes.util.find_library("c")
+    try:
+        clock_gettime = ctypes.CDLL(library_name).clock_gettime
+    except (OSError, AttributeError, TypeError):
+        return time.time
+    timespec = _Timespec()
+
+    def monotonic():
+        clock_gettime(CLOCK_MONOTONIC, ctypes.byref(timespec))
+        return timespec.tv_sec + timespec.tv_nsec * 1e-9
+
+    return monotonic
+
+
+monotonic = _monotonic_clock()
+
+
+# fixed log-spaced bins from 1 us to 100 s, cheap to fill and good enough for percentiles of latencies
+class LatencyHistogram(object):
+    MIN_LATENCY = 1e-6  # s
+    BINS_PER_DECADE = 20
+    DECADES = 8
+
+    def __init__(self):
+        self.counts = np.zeros(self.BINS_PER_DECADE * self.DECADES + 1, dtype=np.int64)
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def record(self, latency):
+        if latency <= self.MIN_LATENCY:
+            index = 0
+        else:
+            index = min(int(math.log10(latency / self.MIN_LATENCY) * self.BINS_PER_DECADE) + 1,
+                        len(self.counts) - 1)
+        self.counts[index] += 1
+        self.total += latency
+        if latency > self.maximum:
+            self.maximum = latency
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    # upper edge of the bin that contains the given percentile, in s
+    def percentile(self, percent):
+        count = self.count
+        if count == 0:
+            return 0.0
+        index = int(np.searchsorted(np.cumsum(self.counts), math.ceil(count * percent / 100.0)))
+        return min(self.MIN_LATENCY * 10 ** (float(index) / self.BINS_PER_DECADE), self.maximum)
+
+
+# writes one record per tick to a CSV file or, for any other file extension, as JSON lines
+class TickExporter(object):
+    def __init__(self, path, fields):
+        self.fields = fields
+        self.export_file = open(path, "w")
+        self.csv_writer = None
+        if os.path.splitext(path)[1] == ".csv":
+            self.csv_writer = csv.DictWriter(self.export_file, fields, extrasaction="ignore")
+            self.csv_writer.writeheader()
+
+    def write(self, record):
+        if self.csv_writer is not None:
+            self.csv_writer.writerow(record)
+        else:
+            self.export_file.write(json.dumps(record) + "\n")
+
+    def close(self):
+        self.export_file.close()
+
+
+# times the stages of every pass of the control loop with lap timestamps
+# usage: start_tick(), then lap("stage") after each stage, then end_tick(counters) to finish the record
+# per Sphero counters are passed to end_tick as arrays and exported as one column per Sphero, e.g. roll_latency_1
+class TickProfiler(object):
+    def __init__(self, stages, export_path=None, counters=(), per_sphero_counters=(), number_of_spheros=0):
+        self.stages = list(stages)
+        self.histograms = dict((stage, LatencyHistogram()) for stage in self.stages)
+        self.tick_histogram = LatencyHistogram()
+        self.events = {}
+        self.events_lock = threading.Lock()
+
+        self.per_sphero_columns = []
+        for name in per_sphero_counters:
+            self.per_sphero_columns.append((name, [name + "_" + str(n + 1) for n in range(number_of_spheros)]))
+
+        self.exporter = None
+        if export_path is not None:
+            fields = ["tick", "time"] + self.stages + ["total"] + list(counters)
+            for _, columns in self.per_sphero_columns:
+                fields += columns
+            self.exporter = TickExporter(export_path, fields)
+
+        self.ticks = 0
+        self.first_tick_time = None
+        self.tick_start = 0.0
+        self.last_lap = 0.0
+        self.record = {}
+
+    def start_tick(self):
+        self.tick_start = self.last_lap = monotonic()
+        if self.first_tick_time is None:
+            self.first_tick_time = self.tick_start
+        self.record = {"tick": self.ticks, "time": time.time()}
+
+    # closes the stage that ran since the last lap (or since start_tick)
+    def lap(self, stage):
+        now = monotonic()
+        duration = now - self.last_lap
+        self.last_lap = now
+        self.histograms[stage].record(duration)
+        self.record[stage] = duration
+
+    def end_tick(self, **counters):
+        total = self.last_lap - self.tick_start
+        self.tick_histogram.record(total)
+        self.record["total"] = total
+        for name, columns in self.per_sphero_columns:
+            values = counters.pop(name, None)
+            if values is not None and self.exporter is not None:
+                self.record.update(zip(columns, np.asarray(values).tolist()))
+        self.record.update(counters)
+        if self.exporter is not None:
+            self.exporter.write(self.record)
+        self.ticks += 1
+
+    # counts events like collisions, safe to call from the driver threads
+    def count_event(self, name):
+        with self.events_lock:
+            self.events[name] = self.events.get(name, 0) + 1
+
+    def summary(self):
+        lines = ["Tick stages in ms over {0} ticks:".format(self.ticks)]
+        for stage, histogram in [(stage, self.histograms[stage]) for stage in self.stages] + \
+                [("total", self.tick_histogram)]:
+            if histogram.count == 0:
+                continue
+            lines.append("{0:>10}: mean {1:8.3f}, p50 {2:8.3f}, p90 {3:8.3f}, p99 {4:8.3f}, max {5:8.3f}".format(
+                stage, 1000 * histogram.total / histogram.count, 1000 * histogram.percentile(50),
+                1000 * histogram.percentile(90), 1000 * histogram.percentile(99), 1000 * histogram.maximum))
+        for name in sorted(self.events):
+            lines.append("{0:>10}: {1} events".format(name, self.events[name]))
+        return "\n".join(lines)
+
+    # seconds since the first tick started
+    def elapsed(self):
+        if self.first_tick_time is None:
+            return 0.0
+        return monotonic() - self.first_tick_time
+
+    def close(self):
+        if self.exporter is not None:
+            self.exporter.close()
+            self.exporter = None